@@ -1,31 +1,64 @@
+import logging
 from flask import Flask
 from config import Config
 from .database import mongo
+from .models import Record
+from . import metrics
 from flask_cors import CORS
 
+logger = logging.getLogger(__name__)
+
 def create_app():
     app = Flask(__name__)
     app.config.from_object(Config)
     CORS(app) 
+    metrics.configure_logging()
+    metrics.init_app(app)
 
     # Initialize MongoDB
+    metrics.register_mongo_listener()
     mongo.init_app(app)
     
     # Ensure MongoDB is connected
     with app.app_context():
         db = mongo.db  # Access the database
         if db is not None:
-            print(f"MongoDB connected to database: {db.name}")
+            logger.info("MongoDB connected to database: %s", db.name)
             # Check if the 'records' collection exists
             if 'records' in db.list_collection_names():
-                print("'records' collection exists.")
+                logger.info("'records' collection exists.")
             else:
-                print("'records' collection does not exist.")
+                logger.info("'records' collection does not exist.")
+            try:
+                Record.ensure_indexes()
+            except Exception as e:
+                logger.error("Failed to create indexes: %s", e)
         else:
-            print("Failed to connect to MongoDB.")
+            logger.error("Failed to connect to MongoDB.")
     
     # Now import routes AFTER initializing mongo
     from .routes import api_blueprint
     app.register_blueprint(api_blueprint, url_prefix='/api')
 
+    from .commands import register_commands
+    register_commands(app)
+
+    if app.config.get("MAINTENANCE_INTERVAL_SECONDS"):
+        from .maintenance import start_sweeper
+        start_sweeper(app.config["MAINTENANCE_INTERVAL_SECONDS"])
+
+    if app.config.get("WARM_UP_MODELS"):
+        from .model_registry import registry
+        registry.warm_up(background=True)
+
     return app
+
+def reinit_after_fork(app):
+    """
+    Replaces connections a forked worker inherited from its parent: pymongo
+    clients are not fork-safe, and pooled HTTP connections must not be
+    shared between processes.
+    """
+    mongo.init_app(app)
+    from .users import reset_session
+    reset_session()
@@ -0,0 +1,132 @@
+import os
+import uuid
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from config import Config
+from .dto import RecordDTO
+from .models import Record
+from .jobs import deidentify_stored_file
+from .metrics import trace_id, traced, capture_stages, add_request_stages
+from .storage import get_storage, upload_key, result_key
+from .results import store_upload, find_cached_result, remember_result, release_output
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    # Threads rather than processes: every file in every batch shares the one
+    # loaded model and its caches, so words from concurrent files are batched
+    # through the same model.
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=Config.BATCH_CONCURRENCY, thread_name_prefix="batch")
+        return _executor
+
+def iter_uploaded_pdfs(files):
+    """
+    Yields (file_name, stream, error) for every PDF among the uploaded files,
+    opening ZIP archives and yielding their PDF members one at a time. An
+    archive or member that cannot be read is yielded with a None stream and
+    the reason in error, and the rest of the batch carries on.
+    """
+    for file in files:
+        if file.filename.lower().endswith(".zip"):
+            try:
+                archive = zipfile.ZipFile(file.stream)
+            except zipfile.BadZipFile:
+                yield file.filename, None, "Not a valid ZIP archive"
+                continue
+            with archive:
+                for member in archive.infolist():
+                    if member.is_dir() or not member.filename.lower().endswith(".pdf"):
+                        continue
+                    file_name = os.path.basename(member.filename)
+                    try:
+                        stream = archive.open(member)
+                    except (zipfile.BadZipFile, RuntimeError, NotImplementedError) as e:
+                        # Corrupt local headers, encrypted members and unsupported compression.
+                        yield file_name, None, f"Could not read ZIP member: {e}"
+                        continue
+                    with stream:
+                        yield file_name, stream, None
+        else:
+            yield file.filename, file.stream, None
+
+def _process(entry, engine, trace):
+    """
+    De-identifies one stored upload. Returns the stage times it took.
+    """
+    record_id = entry["recordId"]
+    with traced(trace), capture_stages() as timings:
+        try:
+            if find_cached_result(record_id, engine) is None:
+                output_key = result_key()
+                deidentify_stored_file(upload_key(record_id), output_key, engine)
+                remember_result(record_id, engine, output_key)
+            entry["status"] = "deidentified"
+        except Exception as e:
+            entry["status"] = "failed"
+            entry["error"] = str(e)
+            get_storage().delete(upload_key(record_id))
+            release_output(record_id)
+    return timings
+
+def run_batch(files, user_id, engine=None):
+    """
+    Stores, de-identifies and records every PDF in files (werkzeug FileStorage
+    objects, possibly ZIP archives). Uploads are stored as they are read from
+    the request while earlier files are already being de-identified, at most
+    BATCH_CONCURRENCY at a time. One failing file does not stop the others.
+
+    Returns:
+    The manifest: one {"fileName", "recordId", "status", "error"} entry per file.
+    """
+    manifest = []
+    futures = []
+    for file_name, stream, error in iter_uploaded_pdfs(files):
+        entry = {"fileName": file_name, "recordId": str(uuid.uuid4()), "status": "uploaded", "error": None}
+        manifest.append(entry)
+        if stream is None:
+            entry["status"] = "failed"
+            entry["error"] = error
+            continue
+        if len(manifest) > Config.BATCH_MAX_FILES:
+            entry["status"] = "failed"
+            entry["error"] = f"Batch is limited to {Config.BATCH_MAX_FILES} files"
+            continue
+        try:
+            store_upload(entry["recordId"], stream)
+        except Exception as e:
+            entry["status"] = "failed"
+            entry["error"] = str(e)
+            continue
+        futures.append(_get_executor().submit(_process, entry, engine, trace_id()))
+
+    for future in futures:
+        add_request_stages(future.result())
+
+    succeeded = [entry for entry in manifest if entry["status"] == "deidentified"]
+    record_dtos = []
+    for entry in succeeded:
+        record_dto = RecordDTO()
+        record_dto.recordId = entry["recordId"]
+        record_dto.recordName = entry["fileName"]
+        record_dto.userId = user_id
+        record_dto.deidentificationDate = datetime.now(timezone.utc)
+        record_dtos.append(record_dto)
+    try:
+        _, failed = Record.create_many(record_dtos)
+    except ValueError as e:
+        failed = {entry["recordId"]: str(e) for entry in succeeded}
+    for entry in succeeded:
+        if entry["recordId"] in failed:
+            entry["status"] = "failed"
+            entry["error"] = failed[entry["recordId"]]
+            get_storage().delete(upload_key(entry["recordId"]))
+            release_output(entry["recordId"])
+        else:
+            entry["status"] = "stored"
+    return manifest
@@ -0,0 +1,111 @@
+import click
+from .models import DeidentificationStats
+
+def register_commands(app):
+    @app.cli.command("rebuild-stats")
+    @click.option("--user-id", default=None, help="Only rebuild the rollups of this user.")
+    def rebuild_stats(user_id):
+        """Backfill the daily de-identification rollups from existing records."""
+        written = DeidentificationStats.rebuild(user_id)
+        click.echo(f"Rebuilt {written} daily rollup documents.")
+
+    @app.cli.command("sweep-storage")
+    def sweep_storage():
+        """Run one storage maintenance pass now and print what it reclaimed."""
+        from .maintenance import sweep
+
+        report = sweep()
+        click.echo(f"Removed files: {report['files'] or 'none'}")
+        click.echo(f"Reclaimed {report['bytes']} bytes, {report['records']} orphaned records "
+                   f"and {report['references']} unclaimed results.")
+
+    @app.cli.command("export-model")
+    @click.option("--output", default=None, help="Artifact path; \".tflite\" for TFLite, anything else for a SavedModel. Defaults to COMPILED_MODEL_PATH.")
+    @click.option("--no-quantize", is_flag=True, help="Keep float32 weights in the TFLite model.")
+    def export_model(output, no_quantize):
+        """Export the classifier and DistilBERT as one compiled graph."""
+        from config import Config
+        from .model_registry import load_models
+        from .compiled_model import export_compiled_model
+
+        output = output or Config.COMPILED_MODEL_PATH
+        fmt = export_compiled_model(load_models("eager"), output, quantize=not no_quantize)
+        click.echo(f"Exported {fmt} model to {output}.")
+
+    @app.cli.command("evaluate-model")
+    @click.argument("corpus", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+    @click.option("--limit", default=5000, show_default=True, help="Distinct words to classify.")
+    @click.option("--batch-size", default=None, type=int, help="Words per model call. Defaults to DEID_BATCH_SIZE.")
+    def evaluate_model(corpus, limit, batch_size):
+        """Compare the compiled model's labels and throughput with the eager models on text or PDF files."""
+        from config import Config
+        from .model_registry import load_models
+        from .compiled_model import compare_backends
+        from .deidentification import extract_text_and_positions
+
+        words = []
+        for path in corpus:
+            if path.lower().endswith(".pdf"):
+                words.extend(word for block in extract_text_and_positions(path) for word in block["text"].split())
+            else:
+                with open(path, encoding="utf-8") as f:
+                    words.extend(f.read().split())
+        eager = load_models("eager")
+        compiled = load_models("compiled")
+        # Words are normalized the same way the pipeline does before classifying.
+        lower = getattr(eager.tokenizer, "lower", True)
+        words = list(dict.fromkeys(word.lower() if lower else word for word in words))[:limit]
+        if not words:
+            raise click.ClickException("No words found in the corpus.")
+
+        report = compare_backends(eager, compiled, words, batch_size or Config.DEID_BATCH_SIZE)
+        click.echo(f"Words: {report['words']}")
+        click.echo(f"Label agreement: {report['agreement']:.4%} (max probability difference {report['maxProbabilityDiff']:.4f})")
+        click.echo(f"Eager: {report['eagerWordsPerSecond']:.1f} words/s")
+        click.echo(f"Compiled ({compiled.backend}): {report['compiledWordsPerSecond']:.1f} words/s")
+        for item in report["disagreements"]:
+            click.echo(f"  {item['word']!r}: eager {item['eager']}, compiled {item['compiled']}")
+
+    @app.cli.command("evaluate-inference-mode")
+    @click.argument("corpus", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+    @click.option("--limit", default=2000, show_default=True, help="Distinct lines to classify.")
+    @click.option("--batch-size", default=None, type=int, help="Words per model call. Defaults to DEID_BATCH_SIZE.")
+    def evaluate_inference_mode(corpus, limit, batch_size):
+        """Compare line-mode labels and speed with word mode on text or PDF files.
+
+        Every text block of a PDF and every line of a text file is one line; of
+        "field - value" lines only the value is used, as in de-identification.
+        """
+        from config import Config
+        from .model_registry import load_models
+        from .deidentification import compare_inference_modes, extract_text_and_positions
+
+        texts = []
+        for path in corpus:
+            if path.lower().endswith(".pdf"):
+                texts.extend(block["text"] for block in extract_text_and_positions(path))
+            else:
+                with open(path, encoding="utf-8") as f:
+                    texts.extend(f.read().splitlines())
+        models = load_models("eager")
+        # Words are normalized the same way the pipeline does before classifying.
+        lower = getattr(models.tokenizer, "lower", True)
+        lines = {}
+        for text in texts:
+            value = text.split(" - ", 1)[1] if " - " in text else text
+            words = tuple(word.lower() if lower else word for word in value.split())
+            if words:
+                lines.setdefault(words, None)
+        lines = [list(words) for words in lines][:limit]
+        if not lines:
+            raise click.ClickException("No lines found in the corpus.")
+
+        report = compare_inference_modes(models, lines, batch_size or Config.DEID_BATCH_SIZE)
+        click.echo(f"Lines: {report['lines']}, words: {report['words']}")
+        click.echo(f"DistilBERT sequences: word mode {report['wordSequences']}, line mode {report['lineSequences']}")
+        click.echo(f"Word mode: {report['wordModeSeconds']:.2f}s, {report['wordModeRedacted']:.2%} of words redacted")
+        click.echo(f"Line mode: {report['lineModeSeconds']:.2f}s, {report['lineModeRedacted']:.2%} of words redacted")
+        click.echo(f"Speedup: {report['speedup']:.2f}x")
+        click.echo(f"Label agreement: {report['agreement']:.4%}")
+        for item in report["disagreements"]:
+            click.echo(f"  {item['word']!r} in {item['line']!r}: word mode {item['wordMode']}, line mode {item['lineMode']}")
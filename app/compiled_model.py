@@ -0,0 +1,141 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import numpy as np
+from .word_cache import file_fingerprint
+
+def export_format(path):
+    return "tflite" if path.endswith(".tflite") else "savedmodel"
+
+def compiled_model_fingerprint(path):
+    if export_format(path) == "savedmodel":
+        return file_fingerprint(os.path.join(path, "saved_model.pb"))
+    return file_fingerprint(path)
+
+def export_compiled_model(models, output_path, quantize=True):
+    """
+    Fuses DistilBERT and the Keras classifier into one graph that maps token
+    ids straight to class probabilities, and writes it to output_path.
+
+    A ".tflite" path produces a TFLite model; with quantize the weights are
+    stored as int8 (dynamic-range quantization, so no calibration set is
+    needed). Any other path produces a SavedModel directory whose serving
+    function is XLA-compiled.
+
+    Parameters:
+    models: eager Models, as returned by load_models("eager").
+    output_path: where the artifact is written.
+    quantize: quantize the TFLite weights to int8. Ignored for SavedModel.
+
+    Returns:
+    The export format, "tflite" or "savedmodel".
+    """
+    import tensorflow as tf
+    from .deidentification import BERT_MAX_LENGTH, MAX_SEQUENCE_LENGTH
+
+    fmt = export_format(output_path)
+    signature = [
+        tf.TensorSpec([None, BERT_MAX_LENGTH], tf.int32, name="input_ids"),
+        tf.TensorSpec([None, BERT_MAX_LENGTH], tf.int32, name="attention_mask"),
+        tf.TensorSpec([None, MAX_SEQUENCE_LENGTH], tf.int32, name="word_ids"),
+    ]
+
+    module = tf.Module()
+    module.bert_model = models.bert_model
+    module.classifier = models.loaded_model
+
+    def serve(input_ids, attention_mask, word_ids):
+        hidden = module.bert_model(input_ids=input_ids, attention_mask=attention_mask, training=False).last_hidden_state
+        return {"probabilities": module.classifier([hidden[:, 0, :], word_ids], training=False)}
+
+    # TFLite does its own graph optimization; XLA only applies to the SavedModel.
+    module.serve = tf.function(serve, input_signature=signature, jit_compile=(fmt == "savedmodel"))
+
+    saved_dir = output_path if fmt == "savedmodel" else tempfile.mkdtemp()
+    try:
+        tf.saved_model.save(module, saved_dir, signatures={"serving_default": module.serve})
+        if fmt == "tflite":
+            converter = tf.lite.TFLiteConverter.from_saved_model(saved_dir)
+            if quantize:
+                converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            # A few transformer ops have no TFLite builtin; they run through the TF kernels.
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+            with open(output_path, "wb") as f:
+                f.write(converter.convert())
+    finally:
+        if fmt == "tflite":
+            shutil.rmtree(saved_dir, ignore_errors=True)
+    return fmt
+
+class CompiledModel:
+    """
+    Serves an artifact written by export_compiled_model.
+    """
+
+    def __init__(self, path, threads=0):
+        import tensorflow as tf
+
+        self.path = path
+        self.format = export_format(path)
+        self.fingerprint = compiled_model_fingerprint(path)
+        # The TFLite interpreter keeps its tensors between calls, so calls are serialized.
+        self._lock = threading.Lock()
+        if self.format == "tflite":
+            interpreter = tf.lite.Interpreter(model_path=path, num_threads=threads or None)
+            self._runner = interpreter.get_signature_runner("serving_default")
+        else:
+            self._runner = tf.saved_model.load(path).signatures["serving_default"]
+
+    def predict(self, input_ids, attention_mask, word_ids):
+        """
+        Returns the class probabilities of each row as a numpy array.
+        """
+        inputs = {
+            "input_ids": np.asarray(input_ids, dtype=np.int32),
+            "attention_mask": np.asarray(attention_mask, dtype=np.int32),
+            "word_ids": np.asarray(word_ids, dtype=np.int32),
+        }
+        if self.format == "tflite":
+            with self._lock:
+                outputs = self._runner(**inputs)
+        else:
+            outputs = self._runner(**inputs)
+        return np.asarray(outputs["probabilities"])
+
+def _timed_predictions(models, words, batch_size):
+    from .deidentification import predict_words
+
+    # The first call pays for graph tracing / XLA compilation; keep it out of the timing.
+    predict_words(models, words[:batch_size], batch_size)
+    started = time.perf_counter()
+    predictions = predict_words(models, words, batch_size)
+    return predictions, time.perf_counter() - started
+
+def compare_backends(eager_models, compiled_models, words, batch_size):
+    """
+    Classifies words with both backends, bypassing the word caches, and
+    reports how often their labels agree and how fast each one is.
+
+    Returns:
+    A dict with the word count, label agreement, largest probability
+    difference, words per second of each backend and up to 20 disagreements.
+    """
+    eager, eager_seconds = _timed_predictions(eager_models, words, batch_size)
+    compiled, compiled_seconds = _timed_predictions(compiled_models, words, batch_size)
+
+    eager_labels = np.argmax(eager, axis=1)
+    compiled_labels = np.argmax(compiled, axis=1)
+    disagreements = [
+        {"word": word, "eager": int(a), "compiled": int(b)}
+        for word, a, b in zip(words, eager_labels, compiled_labels) if a != b
+    ]
+    return {
+        "words": len(words),
+        "agreement": float(np.mean(eager_labels == compiled_labels)) if words else 1.0,
+        "maxProbabilityDiff": float(np.max(np.abs(eager - compiled))) if words else 0.0,
+        "eagerWordsPerSecond": len(words) / eager_seconds if eager_seconds else None,
+        "compiledWordsPerSecond": len(words) / compiled_seconds if compiled_seconds else None,
+        "disagreements": disagreements[:20],
+    }
@@ -1,87 +1,546 @@
 import re
+import time
+import bisect
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from tensorflow.keras.preprocessing.sequence import pad_sequences
-import pickle
-from tensorflow.keras.models import load_model
 import fitz  
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 import os
-from transformers import BertTokenizer, TFBertModel
+from config import Config
+from .word_cache import WordCache
+from .model_registry import registry
+from .rules import rule_classifier, classification_stats
+from .ocr import PageOcr, ocr_page_blocks
+from .scheduler import create_scheduler
+from .metrics import timed, record_stage, should_sample, register, add_collector, configure_logging, trace_id, traced, capture_stages, add_request_stages, Gauge
 
-with open('latest_tokenizer.pkl', 'rb') as f:
-    tokenizer = pickle.load(f)
+logger = logging.getLogger(__name__)
 
-loaded_model = load_model('latest_model.keras')
+def model_version():
+    """
+    Version of the classifier this process has loaded, taken from the model
+    files when they were loaded. Predictions of a process still running an
+    older model are never stored under the version of newer files.
+    """
+    return registry.get().version
 
-bert_tokenizer = BertTokenizer.from_pretrained('distilbert-base-uncased')
-bert_model = TFBertModel.from_pretrained('distilbert-base-uncased')
+def pipeline_version(engine=None):
+    """
+    Version of everything that shapes a de-identified PDF in this process:
+    the models and rule lists as they were loaded, OCR and the output engine.
+    Cached outputs are keyed by it. Loads the models if needed.
+    """
+    engine = engine or Config.DEID_OUTPUT_ENGINE
+    parts = [model_version(), rule_classifier.fingerprint, Config.DEID_INFERENCE_MODE, engine,
+             f"rules={Config.DEID_RULES_ENABLED}", f"ocr={Config.OCR_ENABLED}:{Config.OCR_LANG}:{Config.OCR_DPI}"]
+    return hashlib.sha1(":".join(parts).encode()).hexdigest()[:16]
 
-def get_bert_embedding(word):
-    inputs = bert_tokenizer(word, return_tensors='tf', padding=True, truncation=True, max_length=32)
-    outputs = bert_model(inputs)
-    return outputs.last_hidden_state[:, 0, :]
+embedding_cache = WordCache("embedding", Config.WORD_CACHE_SIZE,
+                            lambda: Config.BERT_MODEL_NAME, Config.WORD_CACHE_PATH)
+prediction_cache = WordCache("prediction", Config.WORD_CACHE_SIZE,
+                             model_version, Config.WORD_CACHE_PATH)
+# Line mode: the probabilities of every word of a line, keyed by the normalized line.
+line_cache = WordCache("line", Config.WORD_CACHE_SIZE,
+                       lambda: model_version() + ":line", Config.WORD_CACHE_PATH)
 
-def deidentify_text(text):
-    words = text.split()
+WORD_CACHE_LOOKUPS = register(Gauge(
+    "deid_word_cache_lookups", "Word cache lookups since start, by cache and result.", ["cache", "result"]))
+WORD_CACHE_SIZE = register(Gauge(
+    "deid_word_cache_entries", "Entries held in the in-process word cache.", ["cache"]))
+RESOLVED_WORDS = register(Gauge(
+    "deid_words_resolved", "Words resolved since start, by classification stage.", ["stage"]))
+
+def _collect_metrics():
+    for cache in (embedding_cache, prediction_cache, line_cache):
+        stats = cache.stats()
+        WORD_CACHE_LOOKUPS.set(stats["hits"], cache=cache.namespace, result="hit")
+        WORD_CACHE_LOOKUPS.set(stats["misses"], cache=cache.namespace, result="miss")
+        WORD_CACHE_SIZE.set(stats["size"], cache=cache.namespace)
+    for stage, count in classification_stats.to_dict()["stages"].items():
+        RESOLVED_WORDS.set(count, stage=stage)
+
+add_collector(_collect_metrics)
+
+def normalize_word(word):
+    # Both tokenizers lowercase their input, so cased variants share one entry.
+    return word.lower() if getattr(registry.get().tokenizer, "lower", True) else word
+
+MAX_SEQUENCE_LENGTH = 1
+BERT_MAX_LENGTH = 32
+# Sub-tokens per line in line mode; longer lines continue in another sequence.
+LINE_MAX_LENGTH = 128
+
+def pad_word_sequences(sequences, maxlen):
+    """
+    Same result as Keras pad_sequences(sequences, padding='post', maxlen=maxlen):
+    long sequences keep their last maxlen ids, short ones are zero-padded at
+    the end. Done in numpy so this path does not need TensorFlow.
+    """
+    padded = np.zeros((len(sequences), maxlen), dtype=np.int32)
+    for row, sequence in enumerate(sequences):
+        sequence = sequence[-maxlen:]
+        padded[row, :len(sequence)] = sequence
+    return padded
+
+def get_bert_embeddings(words, batch_size=None):
+    """
+    Returns the CLS embedding of every word as one (len(words), hidden) array.
+    Words are tokenized together and run through DistilBERT in fixed-size batches;
+    the attention mask keeps padding from changing any word's embedding.
+    """
+    batch_size = batch_size or Config.DEID_BATCH_SIZE
+    cached = embedding_cache.get_many(list(dict.fromkeys(words)))
+    missing = [word for word in dict.fromkeys(words) if word not in cached]
+
+    computed = {}
+    if missing:
+        computed = dict(zip(missing, compute_bert_embeddings(registry.get(), missing, batch_size)))
+    embedding_cache.put_many(computed)
+
+    cached.update(computed)
+    return np.stack([cached[word] for word in words])
+
+def compute_bert_embeddings(models, words, batch_size):
+    """
+    Runs words through DistilBERT in batches and returns their CLS embeddings,
+    without consulting the embedding cache.
+    """
+    embeddings = []
+    for start in range(0, len(words), batch_size):
+        chunk = words[start:start + batch_size]
+        with timed("tokenization", items=len(chunk)):
+            inputs = models.bert_tokenizer(chunk, return_tensors='tf', padding=True, truncation=True, max_length=BERT_MAX_LENGTH)
+        with timed("embedding", items=len(chunk)):
+            outputs = models.bert_model(inputs)
+            embeddings.append(np.asarray(outputs.last_hidden_state[:, 0, :]))
+    return np.concatenate(embeddings)
+
+def predict_words(models, words, batch_size, embeddings=None):
+    """
+    Runs the models on words and returns their class probabilities, one row
+    per word, without consulting the word caches.
+
+    Parameters:
+    models: the Models to run, eager or compiled.
+    words: normalized words to classify.
+    batch_size: words per model call.
+    embeddings: precomputed CLS embeddings of words for the eager backend.
+    """
+    with timed("tokenization", items=len(words)):
+        sequences = models.tokenizer.texts_to_sequences(words)
+        padded_sequences = pad_word_sequences(sequences, MAX_SEQUENCE_LENGTH)
+
+    if models.compiled is None:
+        if embeddings is None:
+            embeddings = compute_bert_embeddings(models, words, batch_size)
+        with timed("classification", items=len(words)):
+            return models.loaded_model.predict([embeddings, padded_sequences], batch_size=batch_size, verbose=0)
+
+    # The compiled graph has a fixed sequence length, so every batch is padded to it.
+    predictions = []
+    for start in range(0, len(words), batch_size):
+        chunk = words[start:start + batch_size]
+        with timed("tokenization", items=len(chunk)):
+            inputs = models.bert_tokenizer(chunk, return_tensors='np', padding='max_length', truncation=True, max_length=BERT_MAX_LENGTH)
+        with timed("classification", items=len(chunk)):
+            predictions.append(models.compiled.predict(inputs["input_ids"], inputs["attention_mask"],
+                                                       padded_sequences[start:start + batch_size]))
+    return np.concatenate(predictions)
+
+def classify_words(words, batch_size=None):
+    """
+    Classifies a list of words and returns one label per word, in the same
+    order as the input (1 means the word should be redacted).
+    Words the rule stage can settle never reach the model; the rest go
+    through classify_words_with_model.
+    """
+    if not words:
+        return []
+    if not Config.DEID_RULES_ENABLED:
+        return classify_words_with_model(words, batch_size)
+
+    labels = [None] * len(words)
+    pending = []
+    with timed("rules", items=len(words)):
+        for index, word in enumerate(words):
+            label, rule = rule_classifier.classify(word)
+            if label is None:
+                pending.append(index)
+            else:
+                labels[index] = label
+                classification_stats.record("rules", rule=rule)
+
+    model_labels = classify_words_with_model([words[index] for index in pending], batch_size)
+    for index, label in zip(pending, model_labels):
+        labels[index] = label
+    return labels
+
+def predict_missing_words(words, batch_size=None):
+    """
+    Predicts words that missed the prediction cache with the registry's models.
+    """
+    models = registry.get()
+    batch_size = batch_size or Config.DEID_BATCH_SIZE
+    # The compiled graph computes the embeddings itself.
+    embeddings = get_bert_embeddings(words, batch_size) if models.compiled is None else None
+    return predict_words(models, words, batch_size, embeddings)
+
+# Concurrent callers in this process share model calls through the scheduler.
+inference_scheduler = create_scheduler(predict_missing_words, Config.INFERENCE_MAX_BATCH_SIZE,
+                                       Config.INFERENCE_MAX_WAIT_MS / 1000)
+
+def classify_words_with_model(words, batch_size=None):
+    """
+    Classifies words with the model in batches.
+    Each distinct normalized word is only sent to the models once; earlier
+    predictions are reused from the prediction cache, and the rest go through
+    the inference scheduler so concurrent callers share model calls.
+    """
+    if not words:
+        return []
+    batch_size = batch_size or Config.DEID_BATCH_SIZE
+
+    keys = [normalize_word(word) for word in words]
+    unique_keys = list(dict.fromkeys(keys))
+    predictions = prediction_cache.get_many(unique_keys)
+    missing = [key for key in unique_keys if key not in predictions]
+    cached_count = sum(1 for key in keys if key in predictions)
+    classification_stats.record("cache", cached_count)
+    classification_stats.record("model", len(keys) - cached_count)
+
+    if missing:
+        if Config.INFERENCE_SCHEDULER_ENABLED:
+            computed = dict(zip(missing, inference_scheduler.predict(missing)))
+        else:
+            computed = dict(zip(missing, predict_missing_words(missing, batch_size)))
+        prediction_cache.put_many(computed)
+        predictions.update(computed)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            for key in missing:
+                if should_sample():
+                    logger.debug("Word: %s, Prediction: %s", key, predictions[key])
+
+    return [int(np.argmax(predictions[key])) for key in keys]
 
-    processed_words = []
+def align_tokens_to_words(words, offsets):
+    """
+    Maps the sub-tokens of " ".join(words) back to the words they came from.
+
+    Parameters:
+    words: the words of the line.
+    offsets: the (start, end) character offsets of every token, as returned by
+    a fast tokenizer with return_offsets_mapping=True. Special and padding
+    tokens have empty offsets.
+
+    Returns:
+    The token positions of every word; a word cut off by truncation has none.
+    """
+    starts = []
+    position = 0
     for word in words:
-        MAX_SEQUENCE_LENGTH = 1
-        sequence = tokenizer.texts_to_sequences([word])
-        padded_sequence = pad_sequences(sequence, padding='post', maxlen=MAX_SEQUENCE_LENGTH)
-        bert_embedding = get_bert_embedding(word).numpy()
-        bert_embedding = np.squeeze(bert_embedding, axis=0)
-
-        prediction = loaded_model.predict([np.array([bert_embedding]), padded_sequence])
-        print(f"Word: {word}, Prediction: {prediction}")
-        predicted_label = np.argmax(prediction, axis=-1)[0] 
-
-        if predicted_label == 1: 
-            processed_words.append("[REDACTED]")
+        starts.append(position)
+        position += len(word) + 1
+    tokens = [[] for _ in words]
+    for token, (start, end) in enumerate(offsets):
+        if end > start:
+            tokens[bisect.bisect_right(starts, start) - 1].append(token)
+    return tokens
+
+def compute_line_embeddings(models, lines, batch_size):
+    """
+    Runs every line through DistilBERT once and returns, per line, a
+    (len(line), hidden) array holding the mean hidden state of each word's
+    sub-tokens, without consulting the caches.
+
+    Lines longer than LINE_MAX_LENGTH tokens continue in another sequence,
+    starting with the word the truncation cut. Words the tokenizer produces no
+    tokens for get their own CLS embedding, as in word mode.
+
+    Parameters:
+    models: eager Models.
+    lines: non-empty lists of words.
+    batch_size: lines per model call.
+    """
+    vectors = [[None] * len(line) for line in lines]
+    pending = [(index, 0) for index in range(len(lines))]
+    while pending:
+        continued = []
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            texts = [" ".join(lines[index][first:]) for index, first in chunk]
+            with timed("tokenization", items=len(chunk)):
+                inputs = models.bert_tokenizer(texts, return_tensors='tf', padding=True, truncation=True,
+                                               max_length=LINE_MAX_LENGTH, return_offsets_mapping=True)
+                offsets = np.asarray(inputs.pop("offset_mapping"))
+                lengths = np.asarray(inputs["attention_mask"]).sum(axis=1)
+            with timed("embedding", items=len(chunk)):
+                hidden = np.asarray(models.bert_model(inputs).last_hidden_state)
+
+            for row, (index, first) in enumerate(chunk):
+                tokens = align_tokens_to_words(lines[index][first:], offsets[row])
+                end = len(tokens)
+                covered = [position for position, word_tokens in enumerate(tokens) if word_tokens]
+                if lengths[row] >= LINE_MAX_LENGTH and covered and offsets[row][:, 1].max() < len(texts[row]):
+                    # The last word may have lost some of its tokens; it starts the continuation
+                    # unless it already started this sequence.
+                    end = covered[-1] if covered[-1] > 0 else 1
+                    continued.append((index, first + end))
+                for position in range(end):
+                    if tokens[position]:
+                        vectors[index][first + position] = hidden[row, tokens[position]].mean(axis=0)
+        pending = continued
+
+    untokenized = list(dict.fromkeys(word for line, line_vectors in zip(lines, vectors)
+                                     for word, vector in zip(line, line_vectors) if vector is None))
+    if untokenized:
+        fallback = dict(zip(untokenized, compute_bert_embeddings(models, untokenized, batch_size)))
+        for line, line_vectors in zip(lines, vectors):
+            for position, word in enumerate(line):
+                if line_vectors[position] is None:
+                    line_vectors[position] = fallback[word]
+    return [np.stack(line_vectors) for line_vectors in vectors]
+
+def predict_lines(models, lines, batch_size):
+    """
+    Runs the models on lines of normalized words in line mode and returns
+    the class probabilities of their words, one array per line, without
+    consulting the caches. Every line is one DistilBERT sequence instead of
+    one sequence per word.
+
+    Parameters:
+    models: eager Models.
+    lines: non-empty lists of words.
+    batch_size: words per classifier call.
+    """
+    if models.compiled is not None:
+        raise ValueError("Line inference needs the eager models; set INFERENCE_BACKEND to eager or auto")
+    words = [word for line in lines for word in line]
+    with timed("tokenization", items=len(words)):
+        padded_sequences = pad_word_sequences(models.tokenizer.texts_to_sequences(words), MAX_SEQUENCE_LENGTH)
+    # Line sequences are up to LINE_MAX_LENGTH / BERT_MAX_LENGTH times longer than
+    # word sequences; fewer per call keeps the tokens of a model call about the same.
+    line_batch_size = max(1, batch_size * BERT_MAX_LENGTH // LINE_MAX_LENGTH)
+    embeddings = np.concatenate(compute_line_embeddings(models, lines, line_batch_size))
+    with timed("classification", items=len(words)):
+        probabilities = models.loaded_model.predict([embeddings, padded_sequences], batch_size=batch_size, verbose=0)
+    return np.split(np.asarray(probabilities), np.cumsum([len(line) for line in lines])[:-1])
+
+def predict_missing_lines(keys, batch_size=None):
+    """
+    Predicts lines that missed the line cache with the registry's models. Each
+    key is a normalized line, its words joined by single spaces.
+    """
+    return predict_lines(registry.get(), [key.split(" ") for key in keys], batch_size or Config.DEID_BATCH_SIZE)
+
+line_scheduler = create_scheduler(predict_missing_lines, Config.INFERENCE_MAX_BATCH_SIZE,
+                                  Config.INFERENCE_MAX_WAIT_MS / 1000)
+
+def classify_lines_with_model(lines, batch_size=None, counts=None):
+    """
+    Line-mode counterpart of classify_words_with_model: classifies lists of
+    words in context and returns one list of labels per line. Each distinct
+    normalized line is only sent to the models once.
+
+    Parameters:
+    lines: lists of words.
+    batch_size: words per classifier call.
+    counts: words of each line to record in the classification stats
+    (default all); the rest were settled by the rule stage and only serve
+    as context.
+    """
+    if not any(lines):
+        return [[] for _ in lines]
+    batch_size = batch_size or Config.DEID_BATCH_SIZE
+    counts = counts or [len(line) for line in lines]
+
+    keys = [" ".join(normalize_word(word) for word in line) for line in lines]
+    unique_keys = list(dict.fromkeys(key for key, line in zip(keys, lines) if line))
+    predictions = line_cache.get_many(unique_keys)
+    missing = [key for key in unique_keys if key not in predictions]
+    cached_count = sum(count for key, count in zip(keys, counts) if key in predictions)
+    classification_stats.record("cache", cached_count)
+    classification_stats.record("model", sum(counts) - cached_count)
+
+    if missing:
+        if Config.INFERENCE_SCHEDULER_ENABLED:
+            computed = dict(zip(missing, line_scheduler.predict(missing)))
         else:
-            processed_words.append(word)
+            computed = dict(zip(missing, predict_missing_lines(missing, batch_size)))
+        line_cache.put_many({key: value.ravel() for key, value in computed.items()})
+        predictions.update(computed)
 
-    return " ".join(processed_words)
+        if logger.isEnabledFor(logging.DEBUG):
+            for key in missing:
+                if should_sample():
+                    logger.debug("Line: %s, Prediction: %s", key, predictions[key])
 
-def extract_text_and_positions(pdf_path):
-    doc = fitz.open(pdf_path)
+    return [np.argmax(np.reshape(predictions[key], (len(line), -1)), axis=1).tolist() if line else []
+            for key, line in zip(keys, lines)]
+
+def classify_lines(lines, batch_size=None):
+    """
+    Classifies lists of words in line mode and returns one list of labels per
+    line. The model sees every word of a line as context, but words the rule
+    stage settles keep the rule's label and lines it settles completely
+    never reach the model.
+    """
+    if not Config.DEID_RULES_ENABLED:
+        return classify_lines_with_model(lines, batch_size)
+
+    labels = [[None] * len(line) for line in lines]
+    pending_lines = []
+    counts = []
+    with timed("rules", items=sum(len(line) for line in lines)):
+        for line_index, line in enumerate(lines):
+            pending = 0
+            for index, word in enumerate(line):
+                label, rule = rule_classifier.classify(word)
+                if label is None:
+                    pending += 1
+                else:
+                    labels[line_index][index] = label
+                    classification_stats.record("rules", rule=rule)
+            if pending:
+                pending_lines.append(line_index)
+                counts.append(pending)
+
+    model_labels = classify_lines_with_model([lines[index] for index in pending_lines], batch_size, counts)
+    for line_index, line_labels in zip(pending_lines, model_labels):
+        labels[line_index] = [model_label if label is None else label
+                              for label, model_label in zip(labels[line_index], line_labels)]
+    return labels
+
+def compare_inference_modes(models, lines, batch_size):
+    """
+    Classifies lines of normalized words in word mode and in line mode,
+    bypassing the caches, and reports how often their labels agree and how
+    long each mode takes.
+
+    Returns:
+    A dict with the line and word counts, the DistilBERT sequences each mode
+    runs, label agreement over every word, the share of words each mode
+    redacts, the seconds each mode took, the speedup of line mode and up to
+    20 disagreements.
+    """
+    words = list(dict.fromkeys(word for line in lines for word in line))
+    # The first calls pay for graph building; keep them out of the timings.
+    predict_words(models, words[:batch_size], batch_size)
+    predict_lines(models, lines[:batch_size], batch_size)
+
+    started = time.perf_counter()
+    word_mode = dict(zip(words, np.argmax(predict_words(models, words, batch_size), axis=1)))
+    word_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    line_mode = [np.argmax(probabilities, axis=1) for probabilities in predict_lines(models, lines, batch_size)]
+    line_seconds = time.perf_counter() - started
+
+    word_labels = np.array([word_mode[word] for line in lines for word in line])
+    line_labels = np.concatenate(line_mode) if lines else np.array([], dtype=int)
+    disagreements = [
+        {"line": " ".join(line), "word": word, "wordMode": int(word_mode[word]), "lineMode": int(label)}
+        for line, labels in zip(lines, line_mode) for word, label in zip(line, labels) if label != word_mode[word]
+    ]
+    return {
+        "lines": len(lines),
+        "words": len(word_labels),
+        "wordSequences": len(words),
+        "lineSequences": len(lines),
+        "agreement": float(np.mean(word_labels == line_labels)) if len(word_labels) else 1.0,
+        "wordModeRedacted": float(np.mean(word_labels == 1)) if len(word_labels) else 0.0,
+        "lineModeRedacted": float(np.mean(line_labels == 1)) if len(line_labels) else 0.0,
+        "wordModeSeconds": word_seconds,
+        "lineModeSeconds": line_seconds,
+        "speedup": word_seconds / line_seconds if line_seconds else None,
+        "disagreements": disagreements[:20],
+    }
+
+def redact_words(words, labels):
+    return " ".join("[REDACTED]" if label == 1 else word for word, label in zip(words, labels))
+
+def deidentify_text(text):
+    words = text.split()
+    if Config.DEID_INFERENCE_MODE == "line":
+        labels = classify_lines([words])[0]
+    else:
+        labels = classify_words(words)
+    return redact_words(words, labels)
+
+def extract_page_blocks(page, page_num):
+    """
+    Returns the non-empty text spans of one page, sorted top to bottom.
+    """
     text_blocks = []
-    
+
     # Use detailed extraction to get font and color info.
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        blocks = page.get_text("dict")["blocks"]
-        for block in blocks:
-            if "lines" in block:
-                for line in block["lines"]:
-                    for span in line["spans"]:
-                        text = span.get("text", "").strip()
-                        if not text:
-                            continue
-                        bbox = span.get("bbox", (0, 0, 0, 0))
-                        font = span.get("font", "Helvetica")
-                        size = span.get("size", 12)
-                        color_int = span.get("color", 0)
-                        r = ((color_int >> 16) & 0xFF) / 255.0
-                        g = ((color_int >> 8) & 0xFF) / 255.0
-                        b = (color_int & 0xFF) / 255.0
-                        rgb_color = (r, g, b)
-                        
-                        text_blocks.append({
-                            "page_num": page_num,
-                            "text": text,
-                            "position": bbox,
-                            "font": font,
-                            "size": size,
-                            "color": rgb_color
-                        })
-    
-    text_blocks.sort(key=lambda block: (block["page_num"], block["position"][1]))
+    blocks = page.get_text("dict")["blocks"]
+    for block in blocks:
+        if "lines" in block:
+            for line in block["lines"]:
+                for span in line["spans"]:
+                    text = span.get("text", "").strip()
+                    if not text:
+                        continue
+                    bbox = span.get("bbox", (0, 0, 0, 0))
+                    font = span.get("font", "Helvetica")
+                    size = span.get("size", 12)
+                    color_int = span.get("color", 0)
+                    r = ((color_int >> 16) & 0xFF) / 255.0
+                    g = ((color_int >> 8) & 0xFF) / 255.0
+                    b = (color_int & 0xFF) / 255.0
+                    rgb_color = (r, g, b)
+
+                    text_blocks.append({
+                        "page_num": page_num,
+                        "text": text,
+                        "position": bbox,
+                        "font": font,
+                        "size": size,
+                        "color": rgb_color
+                    })
+
+    text_blocks.sort(key=lambda block: block["position"][1])
+    return text_blocks
+
+def iter_page_blocks(pdf_path):
+    """
+    Yields (page_num, page_count, text_blocks) one page at a time, so only a
+    single page's spans are held in memory. Pages without a text layer are
+    OCRed when OCR_ENABLED is set.
+    """
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+        page_ocr = PageOcr(pdf_path, doc) if Config.OCR_ENABLED else None
+        for page_num in range(page_count):
+            page = doc.load_page(page_num)
+            with timed("extraction", items=1):
+                text_blocks = extract_page_blocks(page, page_num)
+            if not text_blocks and page_ocr:
+                text_blocks = page_ocr.page_blocks(page, page_num)
+            yield page_num, page_count, text_blocks
+
+def extract_text_and_positions(pdf_path):
+    text_blocks = []
+    for _, _, page_blocks in iter_page_blocks(pdf_path):
+        text_blocks.extend(page_blocks)
     return text_blocks
 
 def create_deidentified_pdf(text_blocks, output_path):
-    c = canvas.Canvas(output_path, pagesize=letter)
+    # text_blocks is usually a lazy page pipeline, so only the time spent
+    # drawing is counted as rendering.
+    started = time.perf_counter()
+    render_seconds = 0.0
+    pages_rendered = 0
+
+    # invariant=1 leaves out the creation time and random document ID, so the
+    # same input always renders to the same bytes.
+    c = canvas.Canvas(output_path, pagesize=letter, invariant=1)
     page_height = letter[1]
     current_page = -1
 
@@ -90,12 +549,15 @@ def create_deidentified_pdf(text_blocks, output_path):
     #     "Aptos-Regular": "Helvetica",
     # }
 
+    render_seconds += time.perf_counter() - started
     for block in text_blocks:
+        started = time.perf_counter()
         page_num = block["page_num"]
         if page_num != current_page:
             if current_page != -1:
                 c.showPage()
             current_page = page_num
+            pages_rendered += 1
 
         text = block["text"]
         x0, y0, x1, y1 = block["position"]
@@ -115,32 +577,298 @@ def create_deidentified_pdf(text_blocks, output_path):
             c.setFont("Helvetica", font_size)
         c.setFillColorRGB(*color)
         c.drawString(x0, y0_adjusted, text)
+        render_seconds += time.perf_counter() - started
 
+    started = time.perf_counter()
     c.save()
+    render_seconds += time.perf_counter() - started
+    record_stage("rendering", render_seconds, pages_rendered)
 
-def deidentify_pdf(input_path, output_path):
-    try:
-        print(f"Input PDF path: {input_path}")
-        print(f"Output PDF path: {output_path}")
+def _word_center_in(word_rect, bbox):
+    x0, y0, x1, y1 = bbox
+    cx = (word_rect[0] + word_rect[2]) / 2
+    cy = (word_rect[1] + word_rect[3]) / 2
+    return x0 <= cx <= x1 and y0 <= cy <= y1
 
-        text_blocks = extract_text_and_positions(input_path)
-        print(f"Extracted {len(text_blocks)} text blocks.")
+def _remove_images(page):
+    """
+    Removes every image from a page that has a text layer. Only the text is
+    classified, so PHI inside such an image could not be found and covered.
+    """
+    boxes = [info["bbox"] for info in page.get_image_info()]
+    if not boxes:
+        return
+    for box in boxes:
+        page.add_redact_annot(fitz.Rect(box), fill=False)
+    page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_REMOVE, graphics=fitz.PDF_REDACT_LINE_ART_NONE,
+                          text=fitz.PDF_REDACT_TEXT_NONE)
 
-        for block in text_blocks:
-            text = block["text"]
-            if " - " in text:
-                field, value = text.split(" - ", 1) 
-                deidentified_value = deidentify_text(value)
-                block["text"] = f"{field} - {deidentified_value}"
-            # else:
-            #     # Use the model for other text (optional)
-            #     block["text"] = deidentify_text(text)
+def _scrub_document(doc):
+    """
+    Removes what the redaction pass does not look at and that can carry PHI:
+    annotations, form fields, the Info and XMP metadata, embedded files,
+    JavaScript, hidden text and thumbnails.
+    """
+    for page in doc:
+        annot = page.first_annot
+        while annot:
+            annot = page.delete_annot(annot)
+        widget = page.first_widget
+        while widget:
+            widget = page.delete_widget(widget)
+    doc.scrub()
+    doc.set_metadata({})
+    doc.del_xml_metadata()
 
-        print("Text de-identified successfully.")
+def _save_reproducibly(doc, output_path):
+    """
+    Saves doc with a document ID derived from its content instead of the
+    input's ID (which identifies the original file) or a random one.
+    """
+    doc.xref_set_key(-1, "ID", "null")
+    digest = hashlib.md5(doc.tobytes(garbage=3, deflate=True, no_new_id=True)).hexdigest()
+    doc.xref_set_key(-1, "ID", f"[<{digest}><{digest}>]")
+    doc.save(output_path, garbage=3, deflate=True, no_new_id=True)
 
-        create_deidentified_pdf(text_blocks, output_path)
-        print(f"De-identified PDF saved to: {output_path}")
+def create_redacted_pdf(input_path, pages, output_path):
+    """
+    Writes output_path by redacting the original PDF in place instead of
+    re-rendering it. Only the boxes of redacted words are covered and their text
+    removed; vector graphics, fonts and layout pass through untouched. Images
+    on pages with a text layer are removed, and annotations, form fields,
+    metadata and embedded files are dropped, as the reportlab engine does.
+
+    pages is an iterable of (page_num, text_blocks) as produced by
+    iter_deidentified_pages.
+    """
+    render_seconds = 0.0
+    pages_rendered = 0
+    with fitz.open(input_path) as doc:
+        for page_num, text_blocks in pages:
+            pages_rendered += 1
+            started = time.perf_counter()
+            page = doc.load_page(page_num)
+            # OCRed pages have no text layer; their words come from Tesseract and
+            # the redaction has to blank the scanned pixels underneath.
+            scanned = any("word_boxes" in block for block in text_blocks)
+            redacted_blocks = [block for block in text_blocks if block.get("redacted_words")]
+            if redacted_blocks:
+                if scanned:
+                    page_words = [tuple(box[1:]) + (box[0],) for block in text_blocks for box in block.get("word_boxes", [])]
+                else:
+                    page_words = page.get_text("words")
+                used = set()
+                for block in redacted_blocks:
+                    located = True
+                    for word in block["redacted_words"]:
+                        for index, page_word in enumerate(page_words):
+                            if index in used or page_word[4] != word:
+                                continue
+                            if _word_center_in(page_word[:4], block["position"]):
+                                used.add(index)
+                                page.add_redact_annot(fitz.Rect(page_word[:4]), fill=(0, 0, 0))
+                                break
+                        else:
+                            located = False
+                    if not located:
+                        # A flagged word the page's words do not match exactly (ligatures,
+                        # split glyph runs) would otherwise stay visible; cover the whole span.
+                        logger.warning("Page %d: could not locate a redacted word, redacting its whole span", page_num + 1)
+                        page.add_redact_annot(fitz.Rect(block["position"]), fill=(0, 0, 0))
+                page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_PIXELS if scanned else fitz.PDF_REDACT_IMAGE_NONE)
+            if not scanned:
+                _remove_images(page)
+            render_seconds += time.perf_counter() - started
+
+        # The output is a new file, so it cannot be an incremental save; garbage
+        # collection drops the redacted text objects instead of leaving them behind.
+        started = time.perf_counter()
+        _scrub_document(doc)
+        _save_reproducibly(doc, output_path)
+        render_seconds += time.perf_counter() - started
+    record_stage("rendering", render_seconds, pages_rendered)
+
+OUTPUT_ENGINES = ("reportlab", "redact")
+
+def deidentify_blocks(text_blocks):
+    """
+    De-identifies the value part of every "field - value" block in place.
+    All candidate words of the blocks are classified in one batched pass and
+    each label is mapped back to the block and word position it came from.
+    Returns the number of words classified.
+    """
+    candidates = []
+    all_words = []
+    for block in text_blocks:
+        text = block["text"]
+        if " - " in text:
+            field, value = text.split(" - ", 1)
+            words = value.split()
+            candidates.append((block, field, len(all_words), len(words)))
+            all_words.extend(words)
+        # else:
+        #     # Use the model for other text (optional)
+        #     block["text"] = deidentify_text(text)
+
+    if Config.DEID_INFERENCE_MODE == "line":
+        # Each value is one DistilBERT sequence, so its words are classified in context.
+        line_labels = classify_lines([all_words[offset:offset + count] for _, _, offset, count in candidates])
+        labels = [label for block_labels in line_labels for label in block_labels]
+    else:
+        labels = classify_words(all_words)
+
+    for block, field, offset, count in candidates:
+        words = all_words[offset:offset + count]
+        block_labels = labels[offset:offset + count]
+        block["text"] = f"{field} - {redact_words(words, block_labels)}"
+        block["redacted_words"] = [word for word, label in zip(words, block_labels) if label == 1]
+
+    return len(all_words)
+
+def iter_deidentified_pages(input_path, progress=None):
+    """
+    Yields (page_num, text_blocks) with each page already de-identified.
+    Pages are extracted and classified lazily, one at a time. progress, if
+    given, is called after every page with the keyword arguments pages_done,
+    pages_total and words_classified.
+    """
+    words_classified = 0
+    for page_num, page_count, text_blocks in iter_page_blocks(input_path):
+        words_classified += deidentify_blocks(text_blocks)
+        yield page_num, text_blocks
+        if progress:
+            progress(pages_done=page_num + 1, pages_total=page_count, words_classified=words_classified)
+
+_page_executor = None
+_page_executor_lock = threading.Lock()
+
+def _init_page_worker():
+    # A module-level function: spawn pickles the initializer, and a bound
+    # method would take the registry and its lock along.
+    configure_logging()
+    registry.warm_up()
+
+def _get_page_executor():
+    global _page_executor
+    with _page_executor_lock:
+        if _page_executor is None:
+            # Each worker loads the models once when it starts and keeps them
+            # for every page range it is given afterwards.
+            _page_executor = ProcessPoolExecutor(
+                max_workers=Config.DEID_PARALLEL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_page_worker
+            )
+        return _page_executor
+
+def _deidentify_page_range(input_path, first_page, last_page, trace):
+    """
+    Runs in a page worker: extracts and de-identifies pages [first_page, last_page).
+    Returns a list of (page_num, text_blocks, words_classified) and the stage
+    times of the range.
+    """
+    results = []
+    with traced(trace), capture_stages() as timings, fitz.open(input_path) as doc:
+        for page_num in range(first_page, last_page):
+            page = doc.load_page(page_num)
+            with timed("extraction", items=1):
+                text_blocks = extract_page_blocks(page, page_num)
+            if not text_blocks and Config.OCR_ENABLED:
+                text_blocks = ocr_page_blocks(input_path, doc, page, page_num)
+            results.append((page_num, text_blocks, deidentify_blocks(text_blocks)))
+    return results, timings
+
+def iter_deidentified_pages_parallel(input_path, progress=None):
+    """
+    Same output as iter_deidentified_pages, but page ranges of
+    DEID_PAGE_CHUNK_SIZE pages are de-identified in DEID_PARALLEL_WORKERS worker
+    processes. Results are yielded in page order; only a window of ranges is in
+    flight at once so finished pages do not pile up ahead of the writer.
+    """
+    with fitz.open(input_path) as doc:
+        page_count = len(doc)
+    chunk_size = Config.DEID_PAGE_CHUNK_SIZE
+    ranges = deque((start, min(start + chunk_size, page_count)) for start in range(0, page_count, chunk_size))
+
+    executor = _get_page_executor()
+    in_flight = deque()
+    words_classified = 0
+    while ranges or in_flight:
+        while ranges and len(in_flight) < Config.DEID_PARALLEL_WORKERS * 2:
+            first_page, last_page = ranges.popleft()
+            in_flight.append(executor.submit(_deidentify_page_range, input_path, first_page, last_page, trace_id()))
+
+        results, timings = in_flight.popleft().result()
+        add_request_stages(timings)
+        for page_num, text_blocks, word_count in results:
+            words_classified += word_count
+            yield page_num, text_blocks
+            if progress:
+                progress(pages_done=page_num + 1, pages_total=page_count, words_classified=words_classified)
+
+def use_parallel_pages(input_path):
+    if Config.DEID_PARALLEL_WORKERS <= 0:
+        return False
+    with fitz.open(input_path) as doc:
+        # A document that fits in a single range gains nothing from the workers.
+        return len(doc) > Config.DEID_PAGE_CHUNK_SIZE
+
+def iter_pages(input_path, progress=None):
+    """
+    Yields (page_num, text_blocks) for every de-identified page, using page
+    workers for large documents when DEID_PARALLEL_WORKERS is set.
+    """
+    if use_parallel_pages(input_path):
+        return iter_deidentified_pages_parallel(input_path, progress)
+    return iter_deidentified_pages(input_path, progress)
+
+def span_record(block):
+    """
+    Describes one de-identified span as a JSON-serializable dict. page is
+    1-based and bbox is (x0, y0, x1, y1) in PDF points from the top left.
+    """
+    return {
+        "page": block["page_num"] + 1,
+        "bbox": [round(float(value), 2) for value in block["position"]],
+        "font": block.get("font"),
+        "size": block.get("size"),
+        "redacted": bool(block.get("redacted_words")),
+        "text": block["text"]
+    }
+
+def iter_span_records(input_path):
+    """
+    Yields the span records of each page as soon as the page is
+    de-identified, as (page_num, records). Nothing is rendered.
+    """
+    for page_num, text_blocks in iter_pages(input_path):
+        yield page_num, [span_record(block) for block in text_blocks]
+
+def deidentify_pdf(input_path, output_path, progress=None, engine=None):
+    """
+    De-identifies input_path into output_path, streaming page by page from
+    extraction through classification to the output engine.
+
+    engine selects how the output is written: "reportlab" re-renders the text
+    onto blank pages, "redact" redacts the original document in place.
+    Defaults to Config.DEID_OUTPUT_ENGINE. Large documents are split across
+    page workers when DEID_PARALLEL_WORKERS is set; the output is the same.
+    """
+    engine = engine or Config.DEID_OUTPUT_ENGINE
+    if engine not in OUTPUT_ENGINES:
+        raise ValueError(f"Unknown output engine: {engine}")
+
+    try:
+        logger.debug("Input PDF path: %s", input_path)
+        logger.debug("Output PDF path: %s", output_path)
+
+        pages = iter_pages(input_path, progress)
+        if engine == "redact":
+            create_redacted_pdf(input_path, pages, output_path)
+        else:
+            create_deidentified_pdf((block for _, text_blocks in pages for block in text_blocks), output_path)
+        logger.info("De-identified PDF saved to: %s", output_path)
 
     except Exception as e:
-        print(f"Error in deidentify_pdf: {e}")
-        raise
\ No newline at end of file
+        logger.error("Error in deidentify_pdf: %s", e)
+        raise
@@ -0,0 +1,304 @@
+import os
+import time
+import logging
+import uuid
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from config import Config
+from .models import JobState
+from .metrics import register, add_collector, configure_logging, record_stage, set_stage_forwarder, trace_id, traced, capture_stages, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+JOBS = register(Gauge("deid_jobs", "De-identification jobs known to this process, by status.", ["status"]))
+JOB_SECONDS = register(Histogram("deid_job_seconds", "Time from job submission to completion.", ["status"]))
+
+class JobQueueFull(Exception):
+    pass
+
+_jobs = {}
+_lock = threading.Lock()
+_executor = None
+_progress_queue = None
+_slots = threading.BoundedSemaphore(Config.DEID_MAX_QUEUED_JOBS)
+# The pipeline version the last finished job of each engine ran with.
+_reported_versions = {}
+
+# Set inside worker processes by _init_worker.
+_worker_queue = None
+
+class Job:
+    def __init__(self, record_id, input_key, output_key, engine=None, on_success=None):
+        self.id = str(uuid.uuid4())
+        self.record_id = record_id
+        self.input_key = input_key
+        self.output_key = output_key
+        self.engine = engine or Config.DEID_OUTPUT_ENGINE
+        self.status = "queued"
+        self.pages_done = 0
+        self.pages_total = None
+        self.words_classified = 0
+        self.error = None
+        self.cached = False
+        # Version of the pipeline that produced the output, reported by the worker.
+        self.pipeline_version = None
+        # Trace id of the submitting request, and the stage times the job spent
+        # on its behalf once it is done.
+        self.trace_id = trace_id()
+        self.stage_timings = {}
+        self.created_at = time.time()
+        self.finished_at = None
+        self.future = None
+        # Called with the job in the web process once the output is written,
+        # before the job is reported as done.
+        self.on_success = on_success
+        self._finished = threading.Event()
+        self._saved_at = 0.0
+        # Saves of one job are serialized so an older state never lands last.
+        self._save_lock = threading.Lock()
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Rebuilds a job another worker runs from its shared state. It can be
+        reported and its output sent, but not waited for.
+        """
+        job = cls(state["recordId"], None, state.get("outputKey"), state.get("engine"))
+        job.id = state["jobId"]
+        job.status = state["status"]
+        job.pages_done = state.get("pagesDone", 0)
+        job.pages_total = state.get("pagesTotal")
+        job.words_classified = state.get("wordsClassified", 0)
+        job.cached = state.get("cached", False)
+        job.error = state.get("error")
+        return job
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the job is done or failed. Returns False on timeout.
+        """
+        return self._finished.wait(timeout)
+
+    def to_dict(self):
+        return {
+            "jobId": self.id,
+            "recordId": self.record_id,
+            "status": self.status,
+            "engine": self.engine,
+            "pagesDone": self.pages_done,
+            "pagesTotal": self.pages_total,
+            "wordsClassified": self.words_classified,
+            "cached": self.cached,
+            "error": self.error
+        }
+
+def _save_job(job):
+    """
+    Writes the job's status to MongoDB so every web worker can report it. A
+    failed write is logged; the job itself carries on.
+    """
+    with job._save_lock:
+        job._saved_at = time.time()
+        try:
+            JobState.save(job.id, dict(job.to_dict(), outputKey=job.output_key), Config.DEID_JOB_TTL_SECONDS)
+        except Exception as e:
+            logger.warning("Could not store the status of job %s: %s", job.id, e)
+
+def _init_worker(queue):
+    global _worker_queue
+    _worker_queue = queue
+    configure_logging()
+    set_stage_forwarder(lambda stage, seconds, items: queue.put((None, {"stage": (stage, seconds, items)})))
+
+def deidentify_stored_file(input_key, output_key, engine=None, progress=None):
+    """
+    De-identifies the stored file input_key into output_key and deletes the
+    upload. The input is checked out of storage to a local file for PyMuPDF
+    and the result committed back.
+    """
+    from .deidentification import deidentify_pdf
+    from .storage import get_storage
+
+    storage = get_storage()
+    input_path = storage.checkout(input_key)
+    try:
+        output_path = storage.scratch(output_key)
+        deidentify_pdf(input_path, output_path, progress=progress, engine=engine)
+        if not os.path.exists(output_path):
+            raise RuntimeError("De-identified PDF could not be created")
+        storage.commit(output_key, output_path)
+    finally:
+        storage.release(input_path)
+
+    storage.delete(input_key)
+    logger.debug("Original file deleted: %s", input_key)
+
+def _run_job(job_id, input_key, output_key, engine, trace):
+    """
+    Runs in a worker process. Progress updates are sent back to the parent
+    through the shared queue, and log records carry the submitting request's
+    trace id. Returns the version of the pipeline the worker ran, which can
+    differ from the parent's, and the job's stage times.
+    """
+    from .deidentification import pipeline_version
+
+    def report(**progress):
+        _worker_queue.put((job_id, progress))
+
+    with traced(trace), capture_stages() as timings:
+        report(status="running")
+        deidentify_stored_file(input_key, output_key, engine, report)
+        version = pipeline_version(engine)
+    return version, timings
+
+def _listen_for_progress(queue):
+    while True:
+        job_id, progress = queue.get()
+        if "stage" in progress:
+            record_stage(*progress["stage"])
+            continue
+        with _lock:
+            job = _jobs.get(job_id)
+            if job is None or job.status in ("done", "failed"):
+                continue
+            if "status" in progress:
+                job.status = progress["status"]
+            if "pages_done" in progress:
+                job.pages_done = progress["pages_done"]
+            if "pages_total" in progress:
+                job.pages_total = progress["pages_total"]
+            if "words_classified" in progress:
+                job.words_classified = progress["words_classified"]
+        # Status changes are shared at once, page progress at most once a second.
+        if "status" in progress or time.time() - job._saved_at >= 1:
+            _save_job(job)
+
+def _get_executor():
+    global _executor, _progress_queue, _worker_queue
+    with _lock:
+        if _executor is None and Config.DEID_JOB_EXECUTOR == "thread":
+            # Jobs share the models and inference scheduler of this process.
+            _progress_queue = _worker_queue = queue.Queue()
+            _executor = ThreadPoolExecutor(max_workers=Config.DEID_MAX_CONCURRENT_JOBS, thread_name_prefix="job")
+            threading.Thread(target=_listen_for_progress, args=(_progress_queue,), daemon=True).start()
+        elif _executor is None:
+            # Spawned workers import the models themselves instead of inheriting a
+            # forked copy of TensorFlow state from the web process.
+            context = multiprocessing.get_context("spawn")
+            _progress_queue = context.Queue()
+            _executor = ProcessPoolExecutor(
+                max_workers=Config.DEID_MAX_CONCURRENT_JOBS,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(_progress_queue,)
+            )
+            threading.Thread(target=_listen_for_progress, args=(_progress_queue,), daemon=True).start()
+        return _executor
+
+def _finish_job(job, future):
+    error = future.exception()
+    if error is None:
+        job.pipeline_version, job.stage_timings = future.result()
+        with _lock:
+            _reported_versions[job.engine] = job.pipeline_version
+    if error is None and job.on_success is not None:
+        try:
+            job.on_success(job)
+        except Exception as e:
+            error = e
+    with _lock:
+        job.finished_at = time.time()
+        if error is None:
+            job.status = "done"
+            if job.pages_total is not None:
+                job.pages_done = job.pages_total
+        else:
+            job.status = "failed"
+            job.error = str(error)
+            logger.error("Job %s failed: %s", job.id, error)
+        JOB_SECONDS.observe(job.finished_at - job.created_at, status=job.status)
+    _save_job(job)
+    job._finished.set()
+    _slots.release()
+
+def _prune_jobs():
+    cutoff = time.time() - Config.DEID_JOB_TTL_SECONDS
+    with _lock:
+        for job_id in [job_id for job_id, job in _jobs.items() if job.finished_at and job.finished_at < cutoff]:
+            del _jobs[job_id]
+
+def submit_job(record_id, input_key, output_key, engine=None, on_success=None):
+    """
+    Queues a de-identification job and returns it immediately.
+    Raises JobQueueFull when DEID_MAX_QUEUED_JOBS jobs are already queued or running.
+    """
+    _prune_jobs()
+    if not _slots.acquire(blocking=False):
+        raise JobQueueFull("Too many de-identification jobs in progress, try again later")
+
+    job = Job(record_id, input_key, output_key, engine, on_success)
+    with _lock:
+        _jobs[job.id] = job
+    _save_job(job)
+    try:
+        job.future = _get_executor().submit(_run_job, job.id, input_key, output_key, job.engine, job.trace_id)
+    except Exception as e:
+        with _lock:
+            del _jobs[job.id]
+        job.status = "failed"
+        job.error = str(e)
+        _save_job(job)
+        _slots.release()
+        raise
+    job.future.add_done_callback(lambda future: _finish_job(job, future))
+    return job
+
+def add_finished_job(record_id, output_key, engine=None):
+    """
+    Registers a job whose output already exists, e.g. one served from the
+    result cache, so clients can treat it like any other job.
+    """
+    _prune_jobs()
+    job = Job(record_id, None, output_key, engine)
+    job.status = "done"
+    job.cached = True
+    job.finished_at = job.created_at
+    job.future = Future()
+    job.future.set_result(None)
+    job._finished.set()
+    with _lock:
+        _jobs[job.id] = job
+    _save_job(job)
+    return job
+
+def reported_pipeline_version(engine=None):
+    """
+    Returns the pipeline version the last finished job of engine ran with, or
+    None before any has finished.
+    """
+    with _lock:
+        return _reported_versions.get(engine or Config.DEID_OUTPUT_ENGINE)
+
+def _collect_metrics():
+    counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+    with _lock:
+        for job in _jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+    for status, count in counts.items():
+        JOBS.set(count, status=status)
+
+add_collector(_collect_metrics)
+
+def get_job(job_id):
+    """
+    Returns the job, whichever web worker runs it, or None if it is unknown
+    or expired.
+    """
+    with _lock:
+        job = _jobs.get(job_id)
+    if job is not None:
+        return job
+    state = JobState.get(job_id)
+    return Job.from_state(state) if state else None
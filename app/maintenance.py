@@ -0,0 +1,202 @@
+import os
+import time
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from pymongo.errors import DuplicateKeyError
+from config import Config
+from .database import mongo
+from .models import Record, ResultCache
+from .results import release_output
+from .storage import get_storage, deidentified_key, UPLOAD_PREFIX, DEIDENTIFIED_PREFIX, RESULT_PREFIX
+from .metrics import register, Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+FILES_REMOVED = register(Counter(
+    "deid_maintenance_files_removed_total", "Files removed by the storage sweeper, by reason.", ["reason"]))
+BYTES_REMOVED = register(Counter(
+    "deid_maintenance_bytes_removed_total", "Bytes reclaimed by the storage sweeper, by reason.", ["reason"]))
+DOCUMENTS_REMOVED = register(Counter(
+    "deid_maintenance_documents_removed_total", "Records and references removed by the storage sweeper.", ["kind"]))
+STORAGE_BYTES = register(Gauge(
+    "deid_storage_bytes", "Bytes stored after the last sweep, by prefix.", ["prefix"]))
+LAST_SWEEP = register(Gauge(
+    "deid_maintenance_last_sweep_timestamp_seconds", "When the storage sweeper last finished."))
+SWEEP_SECONDS = register(Histogram(
+    "deid_maintenance_sweep_seconds", "Duration of storage sweeps.", buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)))
+
+LEGACY_OUTPUT_SUFFIX = "_deidentified.pdf"
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _remove(files, reason, report):
+    """
+    Deletes the (key, size, modified) entries of files in batches and records
+    what was reclaimed.
+    """
+    storage = get_storage()
+    for batch in _chunks(files, Config.MAINTENANCE_BATCH_SIZE):
+        storage.delete_many([key for key, _, _ in batch])
+        reclaimed = sum(size for _, size, _ in batch)
+        FILES_REMOVED.inc(len(batch), reason=reason)
+        BYTES_REMOVED.inc(reclaimed, reason=reason)
+        report["files"][reason] = report["files"].get(reason, 0) + len(batch)
+        report["bytes"] += reclaimed
+
+def _release_unclaimed_refs(before, report):
+    # Uploaded or de-identified, but never stored as a record.
+    stale = ResultCache.stale_ref_ids(before)
+    for batch in _chunks(stale, Config.MAINTENANCE_BATCH_SIZE):
+        existing = Record.existing_ids(batch)
+        for record_id in batch:
+            if record_id not in existing:
+                release_output(record_id)
+                report["references"] += 1
+    DOCUMENTS_REMOVED.inc(report["references"], kind="reference")
+
+def _unclaimed_outputs(outputs, legacy_outputs):
+    unclaimed = []
+    for batch in _chunks(outputs, Config.MAINTENANCE_BATCH_SIZE):
+        referenced = ResultCache.referenced_keys([key for key, _, _ in batch])
+        unclaimed.extend(entry for entry in batch if entry[0] not in referenced)
+    for batch in _chunks(legacy_outputs, Config.MAINTENANCE_BATCH_SIZE):
+        record_ids = {entry[0]: os.path.basename(entry[0])[:-len(LEGACY_OUTPUT_SUFFIX)] for entry in batch}
+        existing = Record.existing_ids(record_ids.values())
+        unclaimed.extend(entry for entry in batch if record_ids[entry[0]] not in existing)
+    return unclaimed
+
+def _remove_orphaned_records(before, stored_keys, report):
+    """
+    Deletes records created before the storage listing whose de-identified
+    file is not in it.
+    """
+    for batch in Record.iter_ids(before, Config.MAINTENANCE_BATCH_SIZE):
+        output_keys = ResultCache.output_keys(batch)
+        orphaned = {}
+        for record_id in batch:
+            key = output_keys.get(record_id, deidentified_key(record_id))
+            if key not in stored_keys:
+                orphaned[record_id] = key
+        if orphaned:
+            deleted = Record.delete_many(orphaned.keys())
+            ResultCache.drop_outputs(orphaned.keys(), orphaned.values())
+            DOCUMENTS_REMOVED.inc(deleted, kind="record")
+            report["records"] += deleted
+
+def sweep():
+    """
+    Runs one maintenance pass over storage and the record collections:
+
+    - releases results of uploads that were never stored as a record;
+    - removes uploads older than UPLOAD_TTL_SECONDS and de-identified files
+      no record uses that are older than OUTPUT_TTL_SECONDS;
+    - with MAINTENANCE_DELETE_ORPHANED_RECORDS and shared storage, deletes
+      records whose de-identified file no longer exists;
+    - when STORAGE_QUOTA_BYTES is exceeded, removes the oldest files that no
+      record uses until usage is back under it.
+
+    With local storage only this node's files are listed, so records are
+    never deleted: their files may live on another node.
+
+    Returns:
+    A report of what was reclaimed.
+    """
+    started = time.time()
+    report = {"files": {}, "bytes": 0, "records": 0, "references": 0}
+    storage = get_storage()
+
+    _release_unclaimed_refs(datetime.now(timezone.utc) - timedelta(seconds=Config.OUTPUT_TTL_SECONDS), report)
+
+    # Records created after this point may point at files missing from the listing.
+    listed_at = datetime.now(timezone.utc)
+    uploads = list(storage.list(UPLOAD_PREFIX))
+    outputs = list(storage.list(RESULT_PREFIX))
+    legacy_outputs = [entry for entry in storage.list(DEIDENTIFIED_PREFIX) if entry[0].endswith(LEGACY_OUTPUT_SUFFIX)]
+
+    expired_uploads = [entry for entry in uploads if entry[2] < started - Config.UPLOAD_TTL_SECONDS]
+    _remove(expired_uploads, "expired_upload", report)
+    unclaimed = _unclaimed_outputs(outputs, legacy_outputs)
+    _remove([entry for entry in unclaimed if entry[2] < started - Config.OUTPUT_TTL_SECONDS], "unclaimed_output", report)
+
+    removed = {key for key, _, _ in expired_uploads}
+    removed.update(key for key, _, modified in unclaimed if modified < started - Config.OUTPUT_TTL_SECONDS)
+    uploads = [entry for entry in uploads if entry[0] not in removed]
+    outputs = [entry for entry in outputs + legacy_outputs if entry[0] not in removed]
+    if Config.MAINTENANCE_DELETE_ORPHANED_RECORDS:
+        if storage.shared:
+            _remove_orphaned_records(listed_at, {key for key, _, _ in outputs}, report)
+        else:
+            logger.warning("MAINTENANCE_DELETE_ORPHANED_RECORDS needs shared storage; skipping orphaned records")
+
+    if Config.STORAGE_QUOTA_BYTES:
+        used = sum(size for _, size, _ in uploads + outputs)
+        # Files still being written or waiting to be claimed get a grace period.
+        grace = started - Config.STORAGE_QUOTA_MIN_AGE_SECONDS
+        candidates = sorted((entry for entry in uploads + [entry for entry in unclaimed if entry[0] not in removed]
+                             if entry[2] < grace), key=lambda entry: entry[2])
+        evicted = []
+        for entry in candidates:
+            if used <= Config.STORAGE_QUOTA_BYTES:
+                break
+            evicted.append(entry)
+            used -= entry[1]
+        _remove(evicted, "quota", report)
+        evicted_keys = {key for key, _, _ in evicted}
+        uploads = [entry for entry in uploads if entry[0] not in evicted_keys]
+        outputs = [entry for entry in outputs if entry[0] not in evicted_keys]
+        if used > Config.STORAGE_QUOTA_BYTES:
+            logger.warning("Storage is over quota after sweeping: %d of %d bytes", used, Config.STORAGE_QUOTA_BYTES)
+
+    STORAGE_BYTES.set(sum(size for _, size, _ in uploads), prefix=UPLOAD_PREFIX)
+    STORAGE_BYTES.set(sum(size for key, size, _ in outputs if key.startswith(RESULT_PREFIX + "/")), prefix=RESULT_PREFIX)
+    STORAGE_BYTES.set(sum(size for key, size, _ in outputs if key.startswith(DEIDENTIFIED_PREFIX + "/")), prefix=DEIDENTIFIED_PREFIX)
+    LAST_SWEEP.set(time.time())
+    SWEEP_SECONDS.observe(time.time() - started)
+    logger.info("Storage sweep reclaimed %s", report)
+    return report
+
+def _lease_id():
+    # Local storage is swept by one process on every node, shared storage by
+    # one process of the whole deployment.
+    if get_storage().shared:
+        return "storage_sweeper"
+    return f"storage_sweeper:{socket.gethostname()}"
+
+def _acquire_lease(seconds):
+    """
+    Takes the sweeper lease for the given number of seconds so only one
+    process sweeps the same storage per interval. Returns False if another
+    holder's lease has not expired yet.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        mongo.db.maintenance_leases.update_one(
+            {"_id": _lease_id(), "expiresAt": {"$lt": now}},
+            {"$set": {"expiresAt": now + timedelta(seconds=seconds), "holder": f"{socket.gethostname()}:{os.getpid()}"}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+def _run_sweeper(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            if _acquire_lease(interval):
+                sweep()
+        except Exception as e:
+            logger.error("Storage sweep failed: %s", e)
+
+def start_sweeper(interval=None):
+    """
+    Starts sweeping every MAINTENANCE_INTERVAL_SECONDS in a daemon thread.
+    """
+    interval = interval or Config.MAINTENANCE_INTERVAL_SECONDS
+    thread = threading.Thread(target=_run_sweeper, args=(interval,), name="storage-sweeper", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,418 @@
+import os
+import json
+import time
+import uuid
+import atexit
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from flask import g, request, has_request_context, Response
+from pymongo import monitoring
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def combine(total, value):
+        return total + value
+
+    def render(self, values=None):
+        """
+        Renders values ({label values: value}), this process's own by default.
+        """
+        values = self.snapshot() if values is None else values
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+class Gauge(Counter):
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self, values=None):
+        lines = super().render(values)
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            series = self._values.setdefault(key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {key: {"buckets": list(series["buckets"]), "sum": series["sum"], "count": series["count"]}
+                    for key, series in self._values.items()}
+
+    @staticmethod
+    def combine(total, series):
+        return {"buckets": [a + b for a, b in zip(total["buckets"], series["buckets"])],
+                "sum": total["sum"] + series["sum"], "count": total["count"] + series["count"]}
+
+    def render(self, values=None):
+        values = self.snapshot() if values is None else values
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        bucket_labels = self.labels + ("le",)
+        for key, series in sorted(values.items()):
+            for bound, count in zip(self.buckets, series["buckets"]):
+                lines.append(f"{self.name}_bucket{_format_labels(bucket_labels, key + (bound,))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(bucket_labels, key + ('+Inf',))} {series['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series['count']}")
+        return lines
+
+_metrics = []
+_collectors = []
+
+def register(metric):
+    _metrics.append(metric)
+    return metric
+
+def _reset_after_fork():
+    # A forked child starts its own series, and a lock held by a parent thread
+    # at fork time would never be released.
+    for metric in _metrics:
+        metric._lock = threading.Lock()
+        metric._values = {}
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def add_collector(collector):
+    """
+    Registers a callable that refreshes gauges right before /metrics is rendered.
+    """
+    _collectors.append(collector)
+
+def _run_collectors():
+    for collector in _collectors:
+        try:
+            collector()
+        except Exception as e:
+            logger.warning("Metrics collector failed: %s", e)
+
+def write_process_metrics(directory):
+    """
+    Writes the samples of this process to directory, where render_metrics in
+    the other server processes picks them up.
+    """
+    _run_collectors()
+    samples = {metric.name: [[list(key), value] for key, value in metric.snapshot().items()] for metric in _metrics}
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(samples, f)
+    os.replace(f"{path}.tmp", path)
+
+def start_metrics_writer(directory, interval):
+    """
+    Writes the metrics of this process to directory every interval seconds and
+    at exit. Threads do not survive fork(), so every server process starts
+    its own.
+    """
+    def write():
+        if not os.path.isdir(directory):
+            # Removed at shutdown before every process got to its last write.
+            return
+        try:
+            write_process_metrics(directory)
+        except Exception as e:
+            logger.warning("Could not write metrics to %s: %s", directory, e)
+
+    def run():
+        while True:
+            time.sleep(interval)
+            write()
+
+    write()
+    atexit.register(write)
+    threading.Thread(target=run, name="metrics-writer", daemon=True).start()
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _read_other_processes(directory):
+    """
+    Returns (samples, alive) for every other process that wrote its metrics
+    to directory.
+    """
+    processes = []
+    for name in os.listdir(directory):
+        pid, extension = os.path.splitext(name)
+        if extension != ".json" or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            with open(os.path.join(directory, name), encoding="utf-8") as f:
+                processes.append((json.load(f), _process_alive(int(pid))))
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read metrics file %s: %s", name, e)
+    return processes
+
+def render_metrics():
+    """
+    Renders the metrics of this process, summed with those the other server
+    processes wrote to METRICS_DIR. Counters and histograms of processes that
+    have exited still count; their gauges no longer do.
+    """
+    _run_collectors()
+    others = _read_other_processes(Config.METRICS_DIR) if Config.METRICS_DIR else []
+    lines = []
+    for metric in _metrics:
+        values = metric.snapshot()
+        for samples, alive in others:
+            if isinstance(metric, Gauge) and not alive:
+                continue
+            for key, value in samples.get(metric.name, []):
+                key = tuple(key)
+                values[key] = metric.combine(values[key], value) if key in values else value
+        lines.extend(metric.render(values))
+    return "\n".join(lines) + "\n"
+
+PROCESS_MEMORY = register(Gauge(
+    "process_memory_bytes", "Memory of this process: rss, pss (shared pages split between their users), shared and private.",
+    ["kind"]))
+
+def read_memory(pid="self"):
+    """
+    Returns the rss, pss, shared and private memory of a process in bytes from
+    /proc/<pid>/smaps_rollup, or None where that is not available.
+    """
+    fields = {"Rss": "rss", "Pss": "pss", "Shared_Clean": "shared", "Shared_Dirty": "shared",
+              "Private_Clean": "private", "Private_Dirty": "private"}
+    memory = {"rss": 0, "pss": 0, "shared": 0, "private": 0}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in fields:
+                    memory[fields[name]] += int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        return None
+    return memory
+
+def _collect_memory():
+    memory = read_memory()
+    for kind, value in (memory or {}).items():
+        PROCESS_MEMORY.set(value, kind=kind)
+
+add_collector(_collect_memory)
+
+STAGE_SECONDS = register(Histogram(
+    "deid_stage_seconds", "Time spent in each pipeline stage.", ["stage"]))
+STAGE_ITEMS = register(Counter(
+    "deid_stage_items_total", "Items (pages, words, calls) handled by each pipeline stage.", ["stage"]))
+REQUEST_SECONDS = register(Histogram(
+    "http_request_seconds", "HTTP request latency.", ["method", "endpoint", "status"]))
+MONGO_SECONDS = register(Histogram(
+    "mongo_command_seconds", "MongoDB command latency.", ["command", "outcome"]))
+
+# Set in worker processes so their stage timings reach the web process's registry.
+_stage_forwarder = None
+
+def set_stage_forwarder(forwarder):
+    global _stage_forwarder
+    _stage_forwarder = forwarder
+
+# Stage times recorded by a thread inside capture_stages().
+_captured_stages = threading.local()
+# Trace id of the request a thread works for outside that request's context.
+_thread_trace = threading.local()
+
+def trace_id():
+    if has_request_context():
+        return getattr(g, "trace_id", None)
+    return getattr(_thread_trace, "trace_id", None)
+
+@contextmanager
+def traced(trace):
+    """
+    Tags the log records of this thread inside the block with trace, for work
+    a job, page or OCR worker does on behalf of a request.
+    """
+    previous = getattr(_thread_trace, "trace_id", None)
+    _thread_trace.trace_id = trace
+    try:
+        yield
+    finally:
+        _thread_trace.trace_id = previous
+
+def record_stage(stage, seconds, items=None):
+    """
+    Records one observation of stage. Inside a request the time is also added
+    to that request's stage breakdown.
+    """
+    if _stage_forwarder is not None:
+        _stage_forwarder(stage, seconds, items)
+    else:
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        if items is not None:
+            STAGE_ITEMS.inc(items, stage=stage)
+    add_request_stages({stage: seconds})
+
+def add_request_stages(timings):
+    """
+    Adds stage times to the current request's stage breakdown, if any, and to
+    the capture_stages() block this thread is in. Used for work another
+    thread or process did on the request's behalf.
+    """
+    targets = []
+    captured = getattr(_captured_stages, "timings", None)
+    if captured is not None:
+        targets.append(captured)
+    if has_request_context():
+        targets.append(g.setdefault("stage_timings", {}))
+    for target in targets:
+        for stage, seconds in timings.items():
+            target[stage] = target.get(stage, 0.0) + seconds
+
+@contextmanager
+def capture_stages():
+    """
+    Collects the stage times this thread records inside the block into the
+    dict it yields, in addition to recording them as usual.
+    """
+    previous = getattr(_captured_stages, "timings", None)
+    _captured_stages.timings = timings = {}
+    try:
+        yield timings
+    finally:
+        _captured_stages.timings = previous
+
+@contextmanager
+def timed(stage, items=None):
+    """
+    Times a block of work as one observation of stage.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started, items)
+
+def should_sample():
+    return random.random() < Config.PREDICTION_LOG_SAMPLE_RATE
+
+class TraceIdFilter(logging.Filter):
+    """
+    Adds the current request's trace id to every log record.
+    """
+
+    def filter(self, record):
+        record.trace_id = trace_id() or "-"
+        return True
+
+def configure_logging(level=None):
+    handler = logging.StreamHandler()
+    handler.addFilter(TraceIdFilter())
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s"))
+    root = logging.getLogger()
+    if not any(isinstance(f, TraceIdFilter) for existing in root.handlers for f in existing.filters):
+        root.addHandler(handler)
+    root.setLevel(level or Config.LOG_LEVEL)
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """
+    Times every MongoDB command. Listeners run on the calling thread, so the
+    time also lands in the current request's stage breakdown.
+    """
+
+    def started(self, event):
+        pass
+
+    def _record(self, event, outcome):
+        elapsed = event.duration_micros / 1e6
+        MONGO_SECONDS.observe(elapsed, command=event.command_name, outcome=outcome)
+        if has_request_context():
+            timings = g.setdefault("stage_timings", {})
+            timings["mongo"] = timings.get("mongo", 0.0) + elapsed
+
+    def succeeded(self, event):
+        self._record(event, "ok")
+
+    def failed(self, event):
+        self._record(event, "error")
+
+_mongo_listener_registered = False
+
+def register_mongo_listener():
+    # Global listeners only apply to clients created afterwards, so this must
+    # run before mongo.init_app.
+    global _mongo_listener_registered
+    if not _mongo_listener_registered:
+        monitoring.register(MongoCommandTimer())
+        _mongo_listener_registered = True
+
+def init_app(app):
+    """
+    Adds request trace ids, request timing, slow-request logging and the
+    Prometheus /metrics endpoint to the app.
+    """
+    @app.before_request
+    def start_trace():
+        g.trace_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+        g.request_started = time.perf_counter()
+        g.stage_timings = {}
+
+    @app.after_request
+    def finish_trace(response):
+        elapsed = time.perf_counter() - g.get("request_started", time.perf_counter())
+        REQUEST_SECONDS.observe(elapsed, method=request.method,
+                                endpoint=request.endpoint or "unknown", status=response.status_code)
+        response.headers["X-Request-ID"] = g.get("trace_id", "")
+        if elapsed >= Config.SLOW_REQUEST_SECONDS:
+            stages = ", ".join(f"{stage}={seconds:.3f}s" for stage, seconds in
+                               sorted(g.get("stage_timings", {}).items(), key=lambda item: -item[1]))
+            logger.warning("Slow request %s %s took %.3fs: %s", request.method, request.path, elapsed, stages or "no stages")
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,199 @@
+import os
+import time
+import pickle
+import logging
+import threading
+from config import Config
+from .word_cache import file_fingerprint
+
+logger = logging.getLogger(__name__)
+
+class Models:
+    """
+    The loaded models used by the de-identification pipeline.
+    """
+
+    def __init__(self, tokenizer, loaded_model, bert_tokenizer, bert_model, compiled=None, fingerprint=None):
+        self.tokenizer = tokenizer
+        self.loaded_model = loaded_model
+        self.bert_tokenizer = bert_tokenizer
+        self.bert_model = bert_model
+        # When set, a CompiledModel replaces bert_model and loaded_model.
+        self.compiled = compiled
+        # Fingerprint of the model files these models were loaded from.
+        self.fingerprint = fingerprint
+
+    @property
+    def backend(self):
+        return "eager" if self.compiled is None else self.compiled.format
+
+    @property
+    def version(self):
+        """
+        Version of these models as loaded. It does not change when the files
+        on disk change under a running process.
+        """
+        version = self.fingerprint or "unversioned"
+        # A quantized model can round differently, so its predictions are versioned separately.
+        if self.compiled is not None:
+            version += ":" + self.compiled.fingerprint
+        return version
+
+def model_files_fingerprint():
+    return file_fingerprint(Config.MODEL_PATH, Config.TOKENIZER_PATH) + ":" + Config.BERT_MODEL_NAME
+
+def _load_compiled_model(backend):
+    """
+    Returns the CompiledModel at COMPILED_MODEL_PATH, or None when the eager
+    models should be used instead.
+    """
+    if backend == "eager":
+        return None
+    path = Config.COMPILED_MODEL_PATH
+    if not os.path.exists(path):
+        if backend == "compiled":
+            raise FileNotFoundError(f"Compiled model not found: {path}")
+        logger.info("No compiled model at %s, using the eager models", path)
+        return None
+
+    from .compiled_model import CompiledModel
+    try:
+        return CompiledModel(path, Config.INFERENCE_THREADS)
+    except Exception as e:
+        if backend == "compiled":
+            raise
+        logger.warning("Could not load compiled model %s, using the eager models: %s", path, e)
+        return None
+
+def configure_tensorflow_threads():
+    """
+    Applies TF_INTRA_OP_THREADS and TF_INTER_OP_THREADS. TensorFlow only
+    accepts them before it runs its first operation in the process.
+    """
+    if not (Config.TF_INTRA_OP_THREADS or Config.TF_INTER_OP_THREADS):
+        return
+    import tensorflow as tf
+    try:
+        if Config.TF_INTRA_OP_THREADS:
+            tf.config.threading.set_intra_op_parallelism_threads(Config.TF_INTRA_OP_THREADS)
+        if Config.TF_INTER_OP_THREADS:
+            tf.config.threading.set_inter_op_parallelism_threads(Config.TF_INTER_OP_THREADS)
+    except RuntimeError as e:
+        logger.warning("TensorFlow thread settings not applied: %s", e)
+
+def load_models(backend=None):
+    """
+    Loads the tokenizers and either the compiled model or the eager models,
+    depending on backend (INFERENCE_BACKEND by default), and records the
+    fingerprint of the files they came from.
+    """
+    while True:
+        fingerprint = model_files_fingerprint()
+        models = _load_models(backend)
+        if model_files_fingerprint() == fingerprint:
+            models.fingerprint = fingerprint
+            return models
+        logger.warning("Model files changed while they were loading, loading them again")
+
+def _load_models(backend):
+    # TensorFlow and transformers are imported here so that importing the app
+    # does not pay for them until a model is actually needed.
+    from transformers import BertTokenizerFast
+
+    configure_tensorflow_threads()
+    with open(Config.TOKENIZER_PATH, 'rb') as f:
+        tokenizer = pickle.load(f)
+    bert_tokenizer = BertTokenizerFast.from_pretrained(Config.BERT_MODEL_NAME)
+
+    backend = backend or Config.INFERENCE_BACKEND
+    # Line mode needs DistilBERT's hidden state for every token, which the
+    # compiled graph does not expose.
+    if Config.DEID_INFERENCE_MODE == "line" and backend == "auto":
+        backend = "eager"
+    compiled = _load_compiled_model(backend)
+    if compiled is not None:
+        return Models(tokenizer, None, bert_tokenizer, None, compiled)
+
+    from tensorflow.keras.models import load_model
+    from transformers import TFBertModel
+
+    loaded_model = load_model(Config.MODEL_PATH)
+    bert_model = TFBertModel.from_pretrained(Config.BERT_MODEL_NAME)
+
+    return Models(tokenizer, loaded_model, bert_tokenizer, bert_model)
+
+class ModelRegistry:
+    """
+    Holds the models and loads them once, on first use or on warm_up().
+    """
+
+    def __init__(self, loader=load_models):
+        self.loader = loader
+        self.state = "not_loaded"
+        self.error = None
+        self.load_seconds = None
+        self._models = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the loaded models, loading them first if needed.
+        Concurrent callers wait for the same load instead of starting their own.
+        """
+        if self._models is not None:
+            return self._models
+        with self._lock:
+            if self._models is None:
+                self.state = "loading"
+                started = time.time()
+                try:
+                    self._models = self.loader()
+                except Exception as e:
+                    self.state = "failed"
+                    self.error = str(e)
+                    raise
+                self.load_seconds = time.time() - started
+                self.state = "ready"
+                self.error = None
+                logger.info("Models loaded in %.1fs (%s backend)", self.load_seconds, self._models.backend)
+        return self._models
+
+    def warm_up(self, background=False):
+        """
+        Loads the models now. With background=True the load runs in a daemon thread.
+        """
+        if background:
+            thread = threading.Thread(target=self._warm_up_quietly, daemon=True)
+            thread.start()
+            return thread
+        return self.get()
+
+    def _warm_up_quietly(self):
+        try:
+            self.get()
+        except Exception as e:
+            logger.error("Model warm-up failed: %s", e)
+
+    def use(self, models):
+        """
+        Replaces the loaded models, e.g. with lightweight stand-ins.
+        """
+        with self._lock:
+            self._models = models
+            self.state = "ready"
+            self.error = None
+
+    @property
+    def ready(self):
+        return self._models is not None
+
+    def status(self):
+        return {
+            "state": self.state,
+            "ready": self.ready,
+            "loadSeconds": self.load_seconds,
+            "backend": self._models.backend if self._models is not None else None,
+            "error": self.error
+        }
+
+registry = ModelRegistry()
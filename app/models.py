@@ -1,11 +1,36 @@
 from gridfs import GridFS
 from werkzeug.utils import secure_filename
 import os
+import json
+import base64
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from .dto import RecordDTO
 from .database import mongo  
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+RECORD_FIELDS = ("recordId", "recordName", "userId", "deidentificationDate")
 
 class Record:
+    @staticmethod
+    def ensure_indexes():
+        """
+        Creates the indexes the record queries rely on. Safe to call on every
+        startup: create_index is a no-op when the index already exists.
+        """
+        collection = Record.get_collection()
+        collection.create_index([("recordId", ASCENDING)], unique=True, name="recordId_unique")
+        # Serves the per-user listing (newest first, recordId as tie-breaker for
+        # cursor pagination) and the per-user date range queries of the stats.
+        collection.create_index(
+            [("userId", ASCENDING), ("deidentificationDate", DESCENDING), ("recordId", DESCENDING)],
+            name="userId_deidentificationDate"
+        )
+        DeidentificationStats.ensure_indexes()
+        ResultCache.ensure_indexes()
+        JobState.ensure_indexes()
+
     @staticmethod
     def get_collection():
         """
@@ -48,12 +73,56 @@ class Record:
             }
 
             Record.get_collection().insert_one(record_data)
+            DeidentificationStats.record(record_dto.userId, record_dto.deidentificationDate, 1)
             return record_dto.recordId
         except Exception as e:
             raise ValueError(f"Validation error: {str(e)}")
 
 
 
+    @staticmethod
+    def create_many(record_dtos):
+        """
+        Creates several records with a single unordered insert_many. Records
+        that fail to insert do not stop the others, and only inserted records
+        are counted in the daily stats.
+
+        Returns:
+        (inserted, failed): the inserted records' IDs, and a dict mapping the
+        ID of every record that was not inserted to the reason.
+
+        Raises:
+        ValueError: If the insert fails as a whole.
+        """
+        if not record_dtos:
+            return [], {}
+        failed = {}
+        try:
+            Record.get_collection().insert_many(
+                [
+                    {
+                        "recordId": record_dto.recordId,
+                        "recordName": record_dto.recordName,
+                        "userId": record_dto.userId,
+                        "deidentificationDate": record_dto.deidentificationDate
+                    }
+                    for record_dto in record_dtos
+                ],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            # An unordered insert still attempts every document; only the
+            # ones listed in writeErrors were not inserted.
+            for error in e.details.get("writeErrors", []):
+                failed[record_dtos[error["index"]].recordId] = f"Validation error: {error.get('errmsg')}"
+        except Exception as e:
+            raise ValueError(f"Validation error: {str(e)}")
+
+        inserted = [record_dto for record_dto in record_dtos if record_dto.recordId not in failed]
+        for record_dto in inserted:
+            DeidentificationStats.record(record_dto.userId, record_dto.deidentificationDate, 1)
+        return [record_dto.recordId for record_dto in inserted], failed
+
     @staticmethod
     def get_all(userId):
         """
@@ -65,6 +134,70 @@ class Record:
         except Exception as e:
             raise ValueError(f"Database error: {str(e)}")
 
+    @staticmethod
+    def encode_cursor(record):
+        payload = {"d": record["deidentificationDate"].isoformat(), "r": record["recordId"]}
+        return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        Returns (deidentificationDate, recordId) from a cursor.
+        Raises ValueError if the cursor is malformed.
+        """
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return datetime.fromisoformat(payload["d"]), payload["r"]
+        except Exception:
+            raise ValueError("Invalid cursor")
+
+    @staticmethod
+    def get_page(userId, limit, cursor=None, fields=None):
+        """
+        Retrieves one page of a user's records, newest first, using keyset
+        pagination on (deidentificationDate, recordId) so every page is an index
+        range scan no matter how deep it is.
+
+        Parameters:
+        - limit: maximum number of records to return.
+        - cursor: the next_cursor of the previous page, or None for the first page.
+        - fields: optional list of record fields to return.
+
+        Returns:
+        (records, next_cursor) where next_cursor is None on the last page.
+        """
+        query = {"userId": userId}
+        if cursor:
+            after_date, after_id = Record.decode_cursor(cursor)
+            query["$or"] = [
+                {"deidentificationDate": {"$lt": after_date}},
+                {"deidentificationDate": after_date, "recordId": {"$lt": after_id}}
+            ]
+
+        projection = {"_id": 0}
+        if fields:
+            # The sort keys are always fetched so the next cursor can be built.
+            for field in set(fields) | {"deidentificationDate", "recordId"}:
+                projection[field] = 1
+
+        try:
+            records = list(
+                Record.get_collection()
+                .find(query, projection)
+                .sort([("deidentificationDate", DESCENDING), ("recordId", DESCENDING)])
+                .limit(limit + 1)
+            )
+        except Exception as e:
+            raise ValueError(f"Database error: {str(e)}")
+
+        next_cursor = None
+        if len(records) > limit:
+            records = records[:limit]
+            next_cursor = Record.encode_cursor(records[-1])
+        if fields:
+            records = [{field: record.get(field) for field in fields} for record in records]
+        return records, next_cursor
+
     @staticmethod
     def get_one(recordId):
         """
@@ -82,63 +215,422 @@ class Record:
         Deletes a record by recordId.
         """
         try:
-            result = Record.get_collection().delete_one({"recordId": recordId})
-            if result.deleted_count == 0:
+            deleted = Record.get_collection().find_one_and_delete(
+                {"recordId": recordId},
+                projection={"userId": 1, "deidentificationDate": 1}
+            )
+            if deleted is None:
                 raise ValueError(f"No record found with recordId: {recordId}")
-            return result.deleted_count  
+            DeidentificationStats.record(deleted.get("userId"), deleted.get("deidentificationDate"), -1)
+            return 1
         except Exception as e:
             raise ValueError(f"Database error: {str(e)}")
         
+    @staticmethod
+    def delete_many(record_ids):
+        """
+        Deletes several records with one delete_many and updates the rollups.
+        Returns the number of records deleted.
+        """
+        collection = Record.get_collection()
+        query = {"recordId": {"$in": list(record_ids)}}
+        deleted = list(collection.find(query, {"_id": 0, "userId": 1, "deidentificationDate": 1}))
+        count = collection.delete_many(query).deleted_count
+        for record in deleted:
+            DeidentificationStats.record(record.get("userId"), record.get("deidentificationDate"), -1)
+        return count
+
+    @staticmethod
+    def existing_ids(record_ids):
+        """
+        Returns the subset of record_ids that have a record.
+        """
+        docs = Record.get_collection().find({"recordId": {"$in": list(record_ids)}}, {"_id": 0, "recordId": 1})
+        return {doc["recordId"] for doc in docs}
+
+    @staticmethod
+    def iter_ids(before, batch_size):
+        """
+        Yields the recordIds of records de-identified before the given time, in
+        lists of at most batch_size.
+        """
+        cursor = Record.get_collection().find(
+            {"deidentificationDate": {"$lt": before}}, {"_id": 0, "recordId": 1}
+        ).batch_size(batch_size)
+        batch = []
+        for doc in cursor:
+            batch.append(doc["recordId"])
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
     @staticmethod
     def update_deidentification_date(record_id, deid_date):
         """
         Updates the record identified by record_id with the provided deidentification date.
         """
         try:
-            Record.get_collection().update_one(
+            previous = Record.get_collection().find_one_and_update(
                 {"recordId": record_id},
-                {"$set": {"deidentificationDate": deid_date}}
+                {"$set": {"deidentificationDate": deid_date}},
+                projection={"userId": 1, "deidentificationDate": 1},
+                return_document=ReturnDocument.BEFORE
             )
+            if previous is not None:
+                DeidentificationStats.record(previous.get("userId"), previous.get("deidentificationDate"), -1)
+                DeidentificationStats.record(previous.get("userId"), deid_date, 1)
         except Exception as e:
             raise ValueError(f"Database error: {str(e)}")
 
     @staticmethod
-    def get_deidentification_counts(user_id, week):
+    def get_deidentification_counts(user_id, week, tz="UTC"):
         """
-        Aggregates and returns the count of de-identified files per day for the given user and week.
-        The aggregation groups by the day of the week (MON-SUN) based on the deidentificationDate.
+        Returns the count of de-identified files per day (MON-SUN) for the given
+        user and week ("this" or "last"), read from the daily rollups.
         """
-        collection = Record.get_collection()
-        now = datetime.utcnow()
-        # Calculate current week's Monday and Sunday
-        monday = now - timedelta(days=now.weekday())
-        sunday = monday + timedelta(days=6)
-        if week == "last":
-            monday = monday - timedelta(days=7)
-            sunday = sunday - timedelta(days=7)
+        return DeidentificationStats.get_week_counts(user_id, week, tz)
+
+WEEKDAY_LABELS = ("MON", "TUE", "WED", "THU", "FRI", "SAT", "SUN")
+GRANULARITIES = ("day", "week", "month")
+
+class DeidentificationStats:
+    """
+    Daily per-user counts of de-identified records, kept up to date as records
+    are created, deleted or re-dated.
+
+    Each document covers one user and one UTC day and holds the day's total plus
+    a count per UTC hour, so a range of N days is answered from N small
+    documents in any time zone. Zones with a non-whole-hour offset are bucketed
+    to the hour.
+    """
+
+    @staticmethod
+    def get_collection():
+        if mongo.db is None:
+            raise ValueError("MongoDB connection is not established.")
+        return mongo.db.deidentification_daily
+
+    @staticmethod
+    def ensure_indexes():
+        DeidentificationStats.get_collection().create_index(
+            [("userId", ASCENDING), ("day", ASCENDING)], unique=True, name="userId_day_unique"
+        )
+
+    @staticmethod
+    def _to_utc(moment):
+        # Naive datetimes are UTC, which is how MongoDB stores and returns them.
+        if moment.tzinfo is None:
+            return moment.replace(tzinfo=timezone.utc)
+        return moment.astimezone(timezone.utc)
+
+    @staticmethod
+    def record(user_id, deid_date, delta):
+        """
+        Adds delta to the counters of the UTC day and hour of deid_date.
+        """
+        if user_id is None or deid_date is None:
+            return
+        moment = DeidentificationStats._to_utc(deid_date)
+        day = datetime(moment.year, moment.month, moment.day)
+        DeidentificationStats.get_collection().update_one(
+            {"userId": user_id, "day": day},
+            {"$inc": {"total": delta, f"hours.{moment.hour}": delta}},
+            upsert=True
+        )
+
+    @staticmethod
+    def rebuild(user_id=None):
+        """
+        Recomputes the rollups from the records collection, for one user or for
+        everyone. Returns the number of rollup documents written.
+        """
+        match = {"deidentificationDate": {"$type": "date"}}
+        if user_id:
+            match["userId"] = user_id
         pipeline = [
-            {
-                "$match": {
-                    "userId": user_id,
-                    "deidentificationDate": {"$gte": monday, "$lte": sunday}
-                }
-            },
+            {"$match": match},
             {
                 "$group": {
-                    "_id": {"$dayOfWeek": "$deidentificationDate"},
+                    "_id": {
+                        "userId": "$userId",
+                        "day": {"$dateTrunc": {"date": "$deidentificationDate", "unit": "day"}},
+                        "hour": {"$hour": "$deidentificationDate"}
+                    },
                     "count": {"$sum": 1}
                 }
             }
         ]
-        results = list(collection.aggregate(pipeline))
-        # MongoDB: Sunday=1, Monday=2, … Saturday=7. Map them to labels.
-        mapping = {2: "MON", 3: "TUE", 4: "WED", 5: "THU", 6: "FRI", 7: "SAT", 1: "SUN"}
-        counts = {"MON": 0, "TUE": 0, "WED": 0, "THU": 0, "FRI": 0, "SAT": 0, "SUN": 0}
-        for doc in results:
-            day_number = doc["_id"]
-            day_label = mapping.get(day_number)
-            if day_label:
-                counts[day_label] = doc["count"]
-        return counts
-
-        
\ No newline at end of file
+        rollups = {}
+        for doc in Record.get_collection().aggregate(pipeline):
+            key = (doc["_id"]["userId"], doc["_id"]["day"])
+            rollup = rollups.setdefault(key, {"userId": key[0], "day": key[1], "total": 0, "hours": {}})
+            rollup["total"] += doc["count"]
+            rollup["hours"][str(doc["_id"]["hour"])] = doc["count"]
+
+        collection = DeidentificationStats.get_collection()
+        collection.delete_many({"userId": user_id} if user_id else {})
+        if rollups:
+            collection.insert_many(list(rollups.values()))
+        return len(rollups)
+
+    @staticmethod
+    def _zone(tz):
+        try:
+            return ZoneInfo(tz)
+        except Exception:
+            raise ValueError(f"Unknown time zone: {tz}")
+
+    @staticmethod
+    def _period(day, granularity):
+        if granularity == "week":
+            return (day - timedelta(days=day.weekday())).isoformat()
+        if granularity == "month":
+            return day.strftime("%Y-%m")
+        return day.isoformat()
+
+    @staticmethod
+    def get_counts(user_id, start, end, granularity="day", tz="UTC"):
+        """
+        Returns the user's counts from start to end (inclusive local dates in
+        time zone tz), grouped by day, week (keyed by its Monday) or month.
+
+        Returns:
+        A list of {"period": ..., "count": ...} in order, including empty periods.
+
+        Raises:
+        ValueError: for an unknown granularity or time zone, or a reversed range.
+        """
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"granularity must be one of: {', '.join(GRANULARITIES)}")
+        if end < start:
+            raise ValueError("end must not be before start")
+        zone = DeidentificationStats._zone(tz)
+
+        counts = {}
+        day = start
+        while day <= end:
+            counts.setdefault(DeidentificationStats._period(day, granularity), 0)
+            day += timedelta(days=1)
+
+        range_start = datetime(start.year, start.month, start.day, tzinfo=zone).astimezone(timezone.utc)
+        range_end = (datetime(end.year, end.month, end.day, tzinfo=zone) + timedelta(days=1)).astimezone(timezone.utc)
+        docs = DeidentificationStats.get_collection().find(
+            {
+                "userId": user_id,
+                "day": {
+                    "$gte": datetime(range_start.year, range_start.month, range_start.day),
+                    "$lt": range_end.replace(tzinfo=None)
+                }
+            },
+            {"_id": 0, "day": 1, "hours": 1}
+        )
+        for doc in docs:
+            for hour, count in (doc.get("hours") or {}).items():
+                local_day = (doc["day"] + timedelta(hours=int(hour))).replace(tzinfo=timezone.utc).astimezone(zone).date()
+                if start <= local_day <= end:
+                    period = DeidentificationStats._period(local_day, granularity)
+                    counts[period] += count
+
+        return [{"period": period, "count": count} for period, count in counts.items()]
+
+    @staticmethod
+    def get_week_counts(user_id, week, tz="UTC"):
+        """
+        Returns {"MON": n, ..., "SUN": n} for this or last week in time zone tz.
+        """
+        today = datetime.now(DeidentificationStats._zone(tz)).date()
+        monday = today - timedelta(days=today.weekday())
+        if week == "last":
+            monday = monday - timedelta(days=7)
+        daily = DeidentificationStats.get_counts(user_id, monday, monday + timedelta(days=6), "day", tz)
+        return {label: entry["count"] for label, entry in zip(WEEKDAY_LABELS, daily)}
+
+class ResultCache:
+    """
+    De-identified outputs shared between records with identical uploads.
+
+    result_cache holds one entry per content hash and pipeline version, with
+    the storage key of its output and how many records use it. result_refs
+    maps every record to the SHA-256 of its upload and to its output, either
+    through a cache entry (cacheKey) or owned outright (cacheKey None).
+    """
+
+    @staticmethod
+    def get_collection():
+        if mongo.db is None:
+            raise ValueError("MongoDB connection is not established.")
+        return mongo.db.result_cache
+
+    @staticmethod
+    def get_refs_collection():
+        if mongo.db is None:
+            raise ValueError("MongoDB connection is not established.")
+        return mongo.db.result_refs
+
+    @staticmethod
+    def ensure_indexes():
+        ResultCache.get_refs_collection().create_index([("recordId", ASCENDING)], unique=True, name="recordId_unique")
+
+    @staticmethod
+    def cache_key(content_hash, version):
+        return f"{content_hash}:{version}"
+
+    @staticmethod
+    def set_content_hash(record_id, content_hash):
+        ResultCache.get_refs_collection().update_one(
+            {"recordId": record_id},
+            {"$set": {"contentHash": content_hash, "updatedAt": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    @staticmethod
+    def get_ref(record_id):
+        return ResultCache.get_refs_collection().find_one({"recordId": record_id}, {"_id": 0})
+
+    @staticmethod
+    def set_ref(record_id, cache_key, output_key):
+        """
+        Points record_id at output_key. Returns the previous reference, if any.
+        """
+        return ResultCache.get_refs_collection().find_one_and_update(
+            {"recordId": record_id},
+            {"$set": {"cacheKey": cache_key, "outputKey": output_key, "updatedAt": datetime.now(timezone.utc)}},
+            projection={"_id": 0},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+
+    @staticmethod
+    def delete_ref(record_id):
+        """
+        Removes the reference of record_id and returns it, or None if there was none.
+        """
+        return ResultCache.get_refs_collection().find_one_and_delete({"recordId": record_id}, projection={"_id": 0})
+
+    @staticmethod
+    def acquire(cache_key):
+        """
+        Takes a reference on a cache entry. Returns its output key, or None on a miss.
+        """
+        entry = ResultCache.get_collection().find_one_and_update(
+            {"_id": cache_key, "refCount": {"$gt": 0}},
+            {"$inc": {"refCount": 1}},
+            projection={"outputKey": 1}
+        )
+        return entry["outputKey"] if entry else None
+
+    @staticmethod
+    def insert(cache_key, content_hash, version, output_key):
+        """
+        Adds a cache entry holding one reference. Returns False when another
+        output was cached under the same key first.
+        """
+        try:
+            ResultCache.get_collection().insert_one({
+                "_id": cache_key,
+                "contentHash": content_hash,
+                "version": version,
+                "outputKey": output_key,
+                "refCount": 1,
+                "createdAt": datetime.now(timezone.utc)
+            })
+            return True
+        except DuplicateKeyError:
+            return False
+
+    @staticmethod
+    def release(cache_key):
+        """
+        Drops one reference on a cache entry. When it was the last one the
+        entry is removed and its output key returned so the file can be
+        deleted; otherwise returns None.
+        """
+        collection = ResultCache.get_collection()
+        entry = collection.find_one_and_update(
+            {"_id": cache_key},
+            {"$inc": {"refCount": -1}},
+            projection={"outputKey": 1, "refCount": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if entry is None or entry["refCount"] > 0:
+            return None
+        # A concurrent acquire may have revived the entry in the meantime.
+        if collection.delete_one({"_id": cache_key, "refCount": {"$lte": 0}}).deleted_count:
+            return entry["outputKey"]
+        return None
+
+    @staticmethod
+    def discard(cache_key):
+        """
+        Removes a cache entry whose output has gone missing.
+        """
+        ResultCache.get_collection().delete_one({"_id": cache_key})
+
+    @staticmethod
+    def stale_ref_ids(before):
+        """
+        Returns the recordIds of references last touched before the given time.
+        """
+        query = {"$or": [{"updatedAt": {"$lt": before}}, {"updatedAt": {"$exists": False}}]}
+        return [doc["recordId"] for doc in ResultCache.get_refs_collection().find(query, {"_id": 0, "recordId": 1})]
+
+    @staticmethod
+    def output_keys(record_ids):
+        """
+        Returns {recordId: outputKey} for the given records that have an output.
+        """
+        docs = ResultCache.get_refs_collection().find(
+            {"recordId": {"$in": list(record_ids)}, "outputKey": {"$ne": None}},
+            {"_id": 0, "recordId": 1, "outputKey": 1}
+        )
+        return {doc["recordId"]: doc["outputKey"] for doc in docs}
+
+    @staticmethod
+    def referenced_keys(output_keys):
+        """
+        Returns the subset of output_keys that a reference or cache entry points at.
+        """
+        query = {"outputKey": {"$in": list(output_keys)}}
+        keys = {doc["outputKey"] for doc in ResultCache.get_refs_collection().find(query, {"_id": 0, "outputKey": 1})}
+        keys.update(doc["outputKey"] for doc in ResultCache.get_collection().find(query, {"outputKey": 1}))
+        return keys
+
+    @staticmethod
+    def drop_outputs(record_ids, output_keys):
+        """
+        Removes the references of record_ids and the cache entries of
+        output_keys, whose files are gone.
+        """
+        ResultCache.get_refs_collection().delete_many({"recordId": {"$in": list(record_ids)}})
+        ResultCache.get_collection().delete_many({"outputKey": {"$in": list(output_keys)}})
+
+class JobState:
+    """
+    Status of de-identification jobs, shared by every web worker so a job can
+    be polled through any of them, not only the one that runs it. Entries
+    expire ttl seconds after their last update.
+    """
+
+    @staticmethod
+    def get_collection():
+        if mongo.db is None:
+            raise ValueError("MongoDB connection is not established.")
+        return mongo.db.jobs
+
+    @staticmethod
+    def ensure_indexes():
+        JobState.get_collection().create_index([("expiresAt", ASCENDING)], expireAfterSeconds=0, name="expiresAt_ttl")
+
+    @staticmethod
+    def save(job_id, state, ttl):
+        JobState.get_collection().update_one(
+            {"_id": job_id},
+            {"$set": dict(state, expiresAt=datetime.now(timezone.utc) + timedelta(seconds=ttl))},
+            upsert=True
+        )
+
+    @staticmethod
+    def get(job_id):
+        return JobState.get_collection().find_one({"_id": job_id}, {"_id": 0, "expiresAt": 0})
@@ -0,0 +1,190 @@
+import os
+import json
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from config import Config
+from .metrics import timed, configure_logging, trace_id, traced
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def needs_ocr(page):
+    """
+    A page without any font resources has no text layer, e.g. a scanned image.
+    """
+    return not page.get_fonts()
+
+def page_content_hash(doc, page):
+    """
+    Hashes what the page draws (its content stream and image streams) together
+    with the OCR settings, so an identical scan reuses the earlier result.
+    """
+    digest = hashlib.sha256(f"{Config.OCR_DPI}:{Config.OCR_LANG}:".encode())
+    digest.update(page.read_contents())
+    for image in page.get_images(full=True):
+        digest.update(doc.xref_stream_raw(image[0]) or b"")
+    return digest.hexdigest()
+
+def ocr_page(pdf_path, page_num, dpi, lang):
+    """
+    Rasterizes one page and runs Tesseract on it. Runs in an OCR worker process.
+    Returns spans (text, position, font, size, color) with positions in PDF
+    points, one span per recognized text line. word_boxes holds each word's
+    [text, x0, y0, x1, y1] so the redaction engine can cover single words.
+    """
+    import pytesseract
+    from pdf2image import convert_from_path
+
+    image = convert_from_path(pdf_path, dpi=dpi, first_page=page_num + 1, last_page=page_num + 1)[0]
+    data = pytesseract.image_to_data(image, lang=lang, output_type=pytesseract.Output.DICT)
+    scale = 72.0 / dpi
+
+    lines = OrderedDict()
+    for i, text in enumerate(data["text"]):
+        text = text.strip()
+        if not text or float(data["conf"][i]) < 0:
+            continue
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        left, top = data["left"][i], data["top"][i]
+        right, bottom = left + data["width"][i], top + data["height"][i]
+        line = lines.setdefault(key, {"words": [], "boxes": [], "bbox": [left, top, right, bottom]})
+        line["words"].append(text)
+        line["boxes"].append([text] + [value * scale for value in (left, top, right, bottom)])
+        bbox = line["bbox"]
+        line["bbox"] = [min(bbox[0], left), min(bbox[1], top), max(bbox[2], right), max(bbox[3], bottom)]
+
+    spans = []
+    for line in lines.values():
+        x0, y0, x1, y1 = (value * scale for value in line["bbox"])
+        spans.append({
+            "text": " ".join(line["words"]),
+            "position": (x0, y0, x1, y1),
+            "font": "Helvetica",
+            "size": round(y1 - y0, 1),
+            "color": (0.0, 0.0, 0.0),
+            "word_boxes": line["boxes"]
+        })
+    return spans
+
+def _ocr_page_traced(trace, pdf_path, page_num, dpi, lang):
+    # Runs in an OCR worker, whose log records carry the request's trace id.
+    with traced(trace):
+        return ocr_page(pdf_path, page_num, dpi, lang)
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=Config.OCR_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=configure_logging
+            )
+        return _executor
+
+def _cache_path(content_hash):
+    return os.path.join(Config.OCR_CACHE_DIR, f"{content_hash}.json")
+
+def get_cached(content_hash):
+    with _cache_lock:
+        if content_hash in _cache:
+            _cache.move_to_end(content_hash)
+            return _cache[content_hash]
+    if Config.OCR_CACHE_DIR and os.path.exists(_cache_path(content_hash)):
+        with open(_cache_path(content_hash), encoding="utf-8") as f:
+            spans = json.load(f)
+        _remember(content_hash, spans)
+        return spans
+    return None
+
+def put_cached(content_hash, spans):
+    _remember(content_hash, spans)
+    if Config.OCR_CACHE_DIR:
+        os.makedirs(Config.OCR_CACHE_DIR, exist_ok=True)
+        path = _cache_path(content_hash)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(spans, f)
+        os.replace(f"{path}.tmp", path)
+
+def _remember(content_hash, spans):
+    with _cache_lock:
+        _cache[content_hash] = spans
+        _cache.move_to_end(content_hash)
+        while len(_cache) > Config.OCR_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def _to_blocks(spans, page_num):
+    return [
+        {
+            "page_num": page_num,
+            "text": span["text"],
+            "position": tuple(span["position"]),
+            "font": span["font"],
+            "size": span["size"],
+            "color": tuple(span["color"]),
+            "word_boxes": span["word_boxes"]
+        }
+        for span in spans
+    ]
+
+def ocr_page_blocks(pdf_path, doc, page, page_num):
+    """
+    OCRs a single page in the calling process, using the cache.
+    """
+    content_hash = page_content_hash(doc, page)
+    spans = get_cached(content_hash)
+    if spans is None:
+        with timed("ocr", items=1):
+            spans = ocr_page(pdf_path, page_num, Config.OCR_DPI, Config.OCR_LANG)
+        put_cached(content_hash, spans)
+    blocks = _to_blocks(spans, page_num)
+    blocks.sort(key=lambda block: block["position"][1])
+    return blocks
+
+class PageOcr:
+    """
+    OCR for one open document. Pages without a text layer are sent to the OCR
+    pool a few at a time ahead of the page being extracted, so Tesseract runs in
+    parallel while only a small window of results is held in memory.
+    """
+
+    def __init__(self, pdf_path, doc):
+        self.pdf_path = pdf_path
+        self.doc = doc
+        self.pending = deque(page_num for page_num in range(len(doc)) if needs_ocr(doc.load_page(page_num)))
+        self.futures = {}
+
+    def _fill(self):
+        while self.pending and len(self.futures) < Config.OCR_WORKERS * 2:
+            page_num = self.pending.popleft()
+            content_hash = page_content_hash(self.doc, self.doc.load_page(page_num))
+            if get_cached(content_hash) is None:
+                future = _get_executor().submit(_ocr_page_traced, trace_id(), self.pdf_path, page_num, Config.OCR_DPI, Config.OCR_LANG)
+                self.futures[page_num] = (content_hash, future)
+
+    def page_blocks(self, page, page_num):
+        """
+        Returns the OCR spans of a page in the same format as extract_page_blocks.
+        """
+        if page_num in self.pending:
+            self.pending.remove(page_num)
+        self._fill()
+
+        if page_num not in self.futures:
+            return ocr_page_blocks(self.pdf_path, self.doc, page, page_num)
+
+        content_hash, future = self.futures.pop(page_num)
+        # Only the wait is visible here; Tesseract itself runs in the OCR pool.
+        with timed("ocr", items=1):
+            spans = future.result()
+        put_cached(content_hash, spans)
+        self._fill()
+        blocks = _to_blocks(spans, page_num)
+        blocks.sort(key=lambda block: block["position"][1])
+        return blocks
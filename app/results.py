@@ -0,0 +1,114 @@
+from config import Config
+from .models import ResultCache
+from .storage import get_storage, upload_key, deidentified_key, HashingReader
+from .deidentification import pipeline_version
+from .model_registry import registry
+from .jobs import reported_pipeline_version
+
+def store_upload(record_id, stream, extension=".pdf"):
+    """
+    Stores an upload and records the SHA-256 of its content, computed while
+    it streams to storage. Returns the hex digest.
+    """
+    reader = HashingReader(stream)
+    get_storage().save(upload_key(record_id, extension), reader)
+    ResultCache.set_content_hash(record_id, reader.hexdigest())
+    return reader.hexdigest()
+
+def _unreferenced_output(ref):
+    """
+    Drops the output reference held by ref and returns the storage key that
+    nothing uses any more, or None.
+    """
+    if ref is None:
+        return None
+    if ref.get("cacheKey"):
+        return ResultCache.release(ref["cacheKey"])
+    return ref.get("outputKey")
+
+def _point_record_at(record_id, cache_key, output_key):
+    previous = ResultCache.set_ref(record_id, cache_key, output_key)
+    stale = _unreferenced_output(previous)
+    if stale and stale != output_key:
+        get_storage().delete(stale)
+
+def _current_pipeline_version(engine):
+    """
+    Version of the pipeline a new job would run. Job worker processes load
+    their own models, so until this process has loaded them the version the
+    last finished job reported is used, and None before any has finished.
+    """
+    if registry.ready or Config.DEID_JOB_EXECUTOR == "thread":
+        return pipeline_version(engine)
+    return reported_pipeline_version(engine)
+
+def find_cached_result(record_id, engine=None):
+    """
+    Looks up an output already produced for the same upload content by the
+    same pipeline. On a hit record_id now references that output and its
+    upload is deleted unprocessed.
+
+    Returns:
+    The storage key of the cached output, or None on a miss.
+    """
+    ref = ResultCache.get_ref(record_id)
+    if not ref or not ref.get("contentHash"):
+        return None
+    version = _current_pipeline_version(engine)
+    if version is None:
+        return None
+    cache_key = ResultCache.cache_key(ref["contentHash"], version)
+    if ref.get("cacheKey") == cache_key:
+        return ref["outputKey"]
+
+    output_key = ResultCache.acquire(cache_key)
+    if output_key is None:
+        return None
+    storage = get_storage()
+    if not storage.exists(output_key):
+        ResultCache.discard(cache_key)
+        return None
+    _point_record_at(record_id, cache_key, output_key)
+    storage.delete(upload_key(record_id))
+    return output_key
+
+def remember_result(record_id, engine, output_key, version=None):
+    """
+    Points record_id at the output a job just wrote and, when the upload's
+    hash is known, offers it to later uploads with the same content. If an
+    identical upload was cached first, the record keeps its own copy.
+
+    version is the pipeline version that produced the output; by default
+    the one of this process.
+    """
+    ref = ResultCache.get_ref(record_id)
+    cache_key = None
+    if ref and ref.get("contentHash"):
+        version = version or pipeline_version(engine)
+        key = ResultCache.cache_key(ref["contentHash"], version)
+        if ResultCache.insert(key, ref["contentHash"], version, output_key):
+            cache_key = key
+    _point_record_at(record_id, cache_key, output_key)
+
+def resolve_output_key(record_id):
+    """
+    Returns the storage key of the de-identified PDF of record_id.
+    """
+    ref = ResultCache.get_ref(record_id)
+    if ref and ref.get("outputKey"):
+        return ref["outputKey"]
+    # Records de-identified before outputs were shared.
+    return deidentified_key(record_id)
+
+def release_output(record_id):
+    """
+    Drops the reference of record_id to its de-identified PDF and deletes the
+    file unless another record still uses it.
+    """
+    ref = ResultCache.delete_ref(record_id)
+    if ref is None:
+        get_storage().delete(deidentified_key(record_id))
+        return
+    stale = _unreferenced_output(ref)
+    if stale:
+        get_storage().delete(stale)
@@ -1,29 +1,28 @@
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, Response, request, jsonify, url_for, stream_with_context
 
 from app.dto import RecordDTO
-from .models import Record
-import pytesseract
-from pdf2image import convert_from_path
-from PIL import Image
+from .models import Record, DeidentificationStats, RECORD_FIELDS
 import tempfile
 import os
 import uuid
-import io
-from .deidentification import deidentify_pdf
-from datetime import datetime
-from .users import get_management_token
-import requests
+import json
+import logging
+from .deidentification import embedding_cache, prediction_cache, iter_span_records, OUTPUT_ENGINES
+from .jobs import submit_job, add_finished_job, get_job, JobQueueFull
+from .batch import run_batch
+from .model_registry import registry
+from .rules import classification_stats
+from .metrics import add_request_stages
+from .storage import get_storage, upload_key, result_key
+from .results import store_upload, find_cached_result, remember_result, resolve_output_key, release_output
+from datetime import datetime, date, timezone
+from .users import get_users as fetch_users
 from config import Config
 
 api_blueprint = Blueprint('api', __name__)
+logger = logging.getLogger(__name__)
 
-UPLOAD_DIR = "uploads"
-if not os.path.exists(UPLOAD_DIR):
-    os.makedirs(UPLOAD_DIR)
-
-DEIDNTIFIED_DIR = "deidentified"
-if not os.path.exists(DEIDNTIFIED_DIR):
-    os.makedirs(DEIDNTIFIED_DIR)
+OUTPUT_FORMATS = ("pdf", "ndjson")
 
 @api_blueprint.route('/uploadFile', methods=['POST'])
 def upload_medical_record():
@@ -34,63 +33,189 @@ def upload_medical_record():
     try:
         recordId = str(uuid.uuid4())
         file_extension = os.path.splitext(file.filename)[1]
-        file_path = os.path.join(UPLOAD_DIR, f"{recordId}{file_extension}")
 
-        file.save(file_path)
+        store_upload(recordId, file.stream, file_extension)
 
         return jsonify({"message": "File uploaded successfully", "recordId": recordId}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+def submit_deidentification(record_id, engine=None):
+    """
+    Queues a de-identification job for an uploaded record. When the same
+    content was already de-identified by the same pipeline, the job is
+    returned finished with the cached output instead.
+    Returns (job, None) on success or (None, error response) otherwise.
+    """
+    if engine and engine not in OUTPUT_ENGINES:
+        return None, (jsonify({"error": f"engine must be one of: {', '.join(OUTPUT_ENGINES)}"}), 400)
+
+    cached_key = find_cached_result(record_id, engine)
+    if cached_key:
+        logger.debug("Result cache hit for %s: %s", record_id, cached_key)
+        return add_finished_job(record_id, cached_key, engine), None
+
+    input_key = upload_key(record_id)
+    output_key = result_key()
+
+    logger.debug("Input file: %s", input_key)
+    logger.debug("Output file: %s", output_key)
+
+    if not get_storage().exists(input_key):
+        return None, (jsonify({"error": "File not found"}), 404)
+
+    def remember(job):
+        remember_result(job.record_id, job.engine, job.output_key, job.pipeline_version)
+
+    try:
+        return submit_job(record_id, input_key, output_key, engine, on_success=remember), None
+    except JobQueueFull as e:
+        return None, (jsonify({"error": str(e)}), 503, {"Retry-After": "30"})
+
+def stream_span_records(record_id):
+    """
+    Streams the de-identified spans of an uploaded record as NDJSON, one line
+    per span, sent as soon as each page is done. No PDF is rendered or stored.
+    The upload is deleted once the whole document has been streamed; if
+    de-identification fails part way, a final {"error": ...} line is sent.
+    """
+    storage = get_storage()
+    input_key = upload_key(record_id)
+    if not storage.exists(input_key):
+        return jsonify({"error": "File not found"}), 404
+    input_path = storage.checkout(input_key)
+
+    def generate():
+        completed = False
+        try:
+            for _, records in iter_span_records(input_path):
+                if records:
+                    yield "".join(json.dumps(record) + "\n" for record in records)
+            completed = True
+        except Exception as e:
+            logger.error("Error streaming spans of %s: %s", record_id, e)
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            storage.release(input_path)
+        if completed:
+            storage.delete(input_key)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
 @api_blueprint.route('/deidentifyFile', methods=['POST'])
 def start_deidentification():
+    """
+    API to de-identify an uploaded record and wait for the result. format=pdf
+    (the default) returns the de-identified PDF; format=ndjson streams the
+    de-identified text spans instead, page by page.
+    """
     record_id = request.args.get("recordId")
     if not record_id:
         return jsonify({"error": "recordId is required"}), 400
+    output_format = request.args.get("format", "pdf")
+    if output_format not in OUTPUT_FORMATS:
+        return jsonify({"error": f"format must be one of: {', '.join(OUTPUT_FORMATS)}"}), 400
+    if output_format == "ndjson":
+        return stream_span_records(record_id)
 
-    input_path = os.path.join(UPLOAD_DIR, f"{record_id}.pdf")
-    output_path = os.path.join(DEIDNTIFIED_DIR, f"{record_id}_deidentified.pdf")
+    job, error_response = submit_deidentification(record_id, request.args.get("engine"))
+    if error_response:
+        return error_response
 
-    print(f"Input file path: {input_path}")
-    print(f"Output file path: {output_path}")
+    try:
+        job.wait()
+        # The job ran in a worker; its stages belong to this request's breakdown.
+        add_request_stages(job.stage_timings)
+        if job.status == "failed":
+            return jsonify({"error": job.error}), 500
+        return get_storage().send(job.output_key, "deidentified.pdf", 'application/pdf')
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-    if not os.path.exists(input_path):
-        return jsonify({"error": "File not found"}), 404
+@api_blueprint.route('/batch/deidentify', methods=['POST'])
+def batch_deidentify():
+    """
+    API to upload, de-identify and store many PDFs in one request. Accepts any
+    number of 'files' parts, each a PDF or a ZIP of PDFs, plus a userId form
+    field. Returns a per-file manifest; failed files are reported, not fatal.
+    """
+    user_id = request.form.get("userId")
+    if not user_id:
+        return jsonify({"error": "userId is required"}), 400
+    files = request.files.getlist("files")
+    if not files:
+        return jsonify({"error": "No file uploaded"}), 400
+    engine = request.form.get("engine")
+    if engine and engine not in OUTPUT_ENGINES:
+        return jsonify({"error": f"engine must be one of: {', '.join(OUTPUT_ENGINES)}"}), 400
 
     try:
-        deidentify_pdf(input_path, output_path)
-        if not os.path.exists(output_path):
-            return jsonify({"error": "De-identified PDF could not be created"}), 500
-
-        os.remove(input_path)
-        print(f"Original file deleted: {input_path}")
-
-        # Read the de-identified file into memory
-        with open(output_path, 'rb') as f:
-            file_data = io.BytesIO(f.read())
-        file_data.seek(0)
-
-        return send_file(file_data,
-                         as_attachment=True,
-                         download_name="deidentified.pdf",
-                         mimetype='application/pdf')
+        manifest = run_batch(files, user_id, engine)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+    stored = sum(1 for entry in manifest if entry["status"] == "stored")
+    return jsonify({
+        "total": len(manifest),
+        "stored": stored,
+        "failed": len(manifest) - stored,
+        "files": manifest
+    }), 200
+
+@api_blueprint.route('/jobs/deidentify', methods=['POST'])
+def create_deidentification_job():
+    """
+    API to queue a de-identification job. Returns the job id without waiting for the result.
+    """
+    record_id = request.args.get("recordId")
+    if not record_id:
+        return jsonify({"error": "recordId is required"}), 400
+
+    job, error_response = submit_deidentification(record_id, request.args.get("engine"))
+    if error_response:
+        return error_response
+    return jsonify(job.to_dict()), 202
+
+@api_blueprint.route('/jobs/<job_id>', methods=['GET'])
+def get_deidentification_job(job_id):
+    """
+    API to report the status and progress of a de-identification job.
+    """
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict()), 200
+
+@api_blueprint.route('/jobs/<job_id>/result', methods=['GET'])
+def get_deidentification_job_result(job_id):
+    """
+    API to download the de-identified PDF of a finished job.
+    """
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    if job.status == "failed":
+        return jsonify({"error": job.error}), 500
+    if job.status != "done":
+        return jsonify({"error": "Job is not finished", "status": job.status}), 409
+    try:
+        return get_storage().send(job.output_key, "deidentified.pdf", 'application/pdf')
+    except FileNotFoundError:
+        return jsonify({"error": "File not found"}), 404
+
 @api_blueprint.route('/delete/deidentifiedFile', methods=['DELETE'])
 def delete_deidentified_file():
     record_id = request.args.get("recordId")
     if not record_id:
         return jsonify({"error": "recordId is required"}), 400
 
-    deidentified_path = os.path.join(DEIDNTIFIED_DIR, f"{record_id}_deidentified.pdf")
-
-    if not os.path.exists(deidentified_path):
+    if not get_storage().exists(resolve_output_key(record_id)):
         return jsonify({"error": "De-identified file not found"}), 404
 
     try:
-        os.remove(deidentified_path)
+        # Other records may share the file; it is only deleted with its last reference.
+        release_output(record_id)
         return jsonify({"message": "De-identified file deleted successfully"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -105,8 +230,7 @@ def store_deidentified_file():
         return jsonify({"error": f"Missing required fields: {', '.join(missing_fields)}"}), 400
 
     record_id = data["recordId"]
-    deidentified_path = os.path.join(DEIDNTIFIED_DIR, f"{record_id}_deidentified.pdf")
-    if not os.path.exists(deidentified_path):
+    if not get_storage().exists(resolve_output_key(record_id)):
         return jsonify({"error": "De-identified file not found"}), 404
 
     try:
@@ -115,7 +239,7 @@ def store_deidentified_file():
         record_dto.recordId = data["recordId"]
         record_dto.recordName = data["recordName"]
         record_dto.userId = data["userId"]
-        record_dto.deidentificationDate = datetime.now()
+        record_dto.deidentificationDate = datetime.now(timezone.utc)
 
 
         saved_record_id = Record.create(record_dto)
@@ -129,13 +253,43 @@ def store_deidentified_file():
 
 @api_blueprint.route('/findAllRecords', methods=['GET'])
 def get_records():
-    user_id = request.args.get("userId")
     """
-    API to retrieve all de-identified records.
+    API to retrieve a user's de-identified records one page at a time, newest first.
+    Query parameters: limit (page size), cursor (from the previous page) and
+    fields (comma-separated list of record fields to return). The cursor of the
+    next page is returned in the X-Next-Cursor header and as a Link rel="next".
     """
+    user_id = request.args.get("userId")
+    try:
+        limit = int(request.args.get("limit", Config.RECORDS_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if limit < 1 or limit > Config.RECORDS_MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {Config.RECORDS_MAX_PAGE_SIZE}"}), 400
+
+    fields = None
+    if request.args.get("fields"):
+        fields = [field.strip() for field in request.args["fields"].split(",") if field.strip()]
+        unknown = [field for field in fields if field not in RECORD_FIELDS]
+        if unknown:
+            return jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            Record.decode_cursor(cursor)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
     try:
-        records = Record.get_all(user_id)
-        return jsonify(records), 200
+        records, next_cursor = Record.get_page(user_id, limit, cursor, fields)
+        headers = {}
+        if next_cursor:
+            next_args = request.args.to_dict()
+            next_args["cursor"] = next_cursor
+            headers["X-Next-Cursor"] = next_cursor
+            headers["Link"] = f'<{url_for("api.get_records", _external=True, **next_args)}>; rel="next"'
+        return jsonify(records), 200, headers
     except ValueError as e:
         return jsonify({"error": str(e)}), 500
 
@@ -166,14 +320,12 @@ def delete_record():
     if not record_id:
         return jsonify({"error": "recordId is required"}), 400
 
-    deidentified_path = os.path.join(DEIDNTIFIED_DIR, f"{record_id}_deidentified.pdf")
-
-    if not os.path.exists(deidentified_path):
+    if not get_storage().exists(resolve_output_key(record_id)):
         return jsonify({"error": "De-identified file not found"}), 404
     
     try:
         deleted_count = Record.delete(record_id)
-        os.remove(deidentified_path)
+        release_output(record_id)
         return jsonify({"message": "Record deleted successfully", "deleted_count": deleted_count}), 200
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
@@ -184,44 +336,74 @@ def download_file():
     if not record_id:
         return jsonify({"error": "recordId is required"}), 400
 
-    file_path = os.path.join(DEIDNTIFIED_DIR, f"{record_id}_deidentified.pdf")
-    if not os.path.exists(file_path):
-        return jsonify({"error": "File not found"}), 404
-
     try:
-        with open(file_path, 'rb') as f:
-            file_data = io.BytesIO(f.read())
-        file_data.seek(0)
-        return send_file(file_data,
-                    as_attachment=True,
-                    download_name="deidentified.pdf",
-                    mimetype='application/pdf')
+        return get_storage().send(resolve_output_key(record_id), "deidentified.pdf", 'application/pdf')
+    except FileNotFoundError:
+        return jsonify({"error": "File not found"}), 404
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
 @api_blueprint.route('/stats/deidentified', methods=['GET'])
 def get_deidentified_stats():
+    """
+    API to count a user's de-identified files.
+    With start and end (YYYY-MM-DD, inclusive) returns a list of
+    {"period", "count"} grouped by granularity (day, week or month) in time
+    zone tz. Without them returns the MON-SUN counts of week ("this" or "last").
+    """
     user_id = request.args.get("userId")
     week = request.args.get("week", "this")
+    tz = request.args.get("tz", "UTC")
     if not user_id:
         return jsonify({"error": "userId is required"}), 400
 
     try:
-        stats = Record.get_deidentification_counts(user_id, week)
+        if request.args.get("start") or request.args.get("end"):
+            try:
+                start = date.fromisoformat(request.args["start"])
+                end = date.fromisoformat(request.args["end"])
+            except (KeyError, ValueError):
+                return jsonify({"error": "start and end must both be dates in YYYY-MM-DD format"}), 400
+            granularity = request.args.get("granularity", "day")
+            stats = DeidentificationStats.get_counts(user_id, start, end, granularity, tz)
+        else:
+            stats = Record.get_deidentification_counts(user_id, week, tz)
         return jsonify(stats), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
+@api_blueprint.route('/ready', methods=['GET'])
+def get_readiness():
+    """
+    API to report whether the de-identification models are loaded.
+    Pass warmUp=true to start loading them in the background.
+    """
+    if request.args.get("warmUp", "false").lower() == "true" and registry.state in ("not_loaded", "failed"):
+        registry.warm_up(background=True)
+    return jsonify(registry.status()), 200 if registry.ready else 503
+
+@api_blueprint.route('/stats/wordCache', methods=['GET'])
+def get_word_cache_stats():
+    """
+    API to report hit/miss counters of the per-word embedding and prediction caches.
+    """
+    return jsonify({
+        "embedding": embedding_cache.stats(),
+        "prediction": prediction_cache.stats()
+    }), 200
+
+@api_blueprint.route('/stats/classification', methods=['GET'])
+def get_classification_stats():
+    """
+    API to report what fraction of words the rules, the prediction cache and the model resolved.
+    """
+    return jsonify(classification_stats.to_dict()), 200
+
 @api_blueprint.route('/findAllUsers', methods=['GET'])
 def get_users():
     try:
-        token = get_management_token()
-        headers = {
-            'Authorization': f'Bearer {token}'
-        }
-        users_url = f'https://{Config.AUTH0_DOMAIN}/api/v2/users'
-        users_response = requests.get(users_url, headers=headers)
-        users_response.raise_for_status()
-        return jsonify(users_response.json()), 200
+        return jsonify(fetch_users()), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
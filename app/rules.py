@@ -0,0 +1,121 @@
+import re
+import hashlib
+import threading
+from config import Config
+from .word_cache import file_fingerprint
+
+# Structured identifiers that are PHI whatever the model would say.
+PHI_PATTERNS = {
+    "email": re.compile(r"^[\w.+-]+@[\w-]+(\.[\w-]+)+$"),
+    "phone": re.compile(r"^(\+\d{1,3}[-.]?)?(\(\d{2,4}\)|\d{2,4})[-.]\d{3,4}[-.]\d{3,4}$|^\d{10,11}$"),
+    "date": re.compile(r"^(\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}|\d{4}[/.-]\d{1,2}[/.-]\d{1,2})$"),
+    "ssn": re.compile(r"^\d{3}-\d{2}-\d{4}$"),
+    "mrn": re.compile(r"^(mrn[:#-]?)?\d{6,9}$", re.IGNORECASE),
+    "url": re.compile(r"^(https?://|www\.)\S+$", re.IGNORECASE),
+}
+
+# Tokens that can never identify anyone. Bare integers are left to the model:
+# street numbers and ages over 89 are identifiers.
+PUNCTUATION = re.compile(r"^[\W_]+$")
+PERCENTAGE = re.compile(r"^\d{1,3}(\.\d+)?%$")
+
+# Words that are never names; common words that are also names (Will, Ward,
+# An, More) are left to the model.
+DEFAULT_ALLOWLIST = frozenset("""
+a about above after again against all am and any are as at be because been before being below between
+both but by can did do does doing down during each few for from further had has have having he her here
+hers him his how i if in into is it its itself just me most my no nor not now of off on once only or
+other our out over own same she should so some such than that the their them then there these they this
+those through to too under until up very was we were what when where which while who whom why with
+you your
+patient name date birth dob age sex gender male female address phone email mrn record number id
+admission discharge admitted discharged visit physician doctor dr nurse hospital clinic department
+diagnosis history medication medications dose dosage mg ml mcg tablet tablets capsule daily twice
+allergies allergy none known unknown yes n/a na normal abnormal negative positive left right blood
+pressure heart rate temperature weight height bmi notes note signed
+""".split())
+
+def normalize_term(word):
+    return word.strip(".,;:()[]{}\"'").lower()
+
+def _load_terms(path):
+    if not path:
+        return frozenset()
+    with open(path, encoding="utf-8") as f:
+        return frozenset(normalize_term(line) for line in f if line.strip())
+
+def _builtin_rules_version():
+    rules = sorted(DEFAULT_ALLOWLIST) + [pattern.pattern for pattern in PHI_PATTERNS.values()] + [PUNCTUATION.pattern, PERCENTAGE.pattern]
+    return hashlib.sha1("\n".join(rules).encode()).hexdigest()[:16]
+
+class RuleClassifier:
+    """
+    Settles obvious words without the model: structured identifiers and
+    denylisted terms are PHI, punctuation, percentages and allowlisted terms
+    are safe, everything else is left for the model.
+    """
+
+    def __init__(self, allowlist_path=None, denylist_path=None):
+        # Taken before the lists are read, so a list edited during the load
+        # is not recorded under its new fingerprint.
+        self.fingerprint = file_fingerprint(*[path for path in (allowlist_path, denylist_path) if path]) + ":" + _builtin_rules_version()
+        self.allowlist = DEFAULT_ALLOWLIST | _load_terms(allowlist_path)
+        self.denylist = _load_terms(denylist_path)
+
+    def classify(self, word):
+        """
+        Returns (label, stage): label is 1 for PHI, 0 for safe or None when the
+        word needs the model; stage names the rule that decided.
+        """
+        term = normalize_term(word)
+        if not term:
+            return 0, "punctuation"
+        if term in self.denylist:
+            return 1, "denylist"
+        # Brackets are kept here so "(02)-9555-1234" still reads as a phone number.
+        identifier = word.strip(".,;:\"'")
+        for name, pattern in PHI_PATTERNS.items():
+            if pattern.match(identifier):
+                return 1, name
+        if PUNCTUATION.match(term):
+            return 0, "punctuation"
+        if PERCENTAGE.match(term):
+            return 0, "percentage"
+        if term in self.allowlist:
+            return 0, "allowlist"
+        return None, None
+
+class ClassificationStats:
+    """
+    Counts how many words each stage (rules, prediction cache, model) resolved.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {"rules": 0, "cache": 0, "model": 0}
+            self.rules = {}
+
+    def record(self, stage, count=1, rule=None):
+        if not count:
+            return
+        with self._lock:
+            self.stages[stage] += count
+            if rule:
+                self.rules[rule] = self.rules.get(rule, 0) + count
+
+    def to_dict(self):
+        with self._lock:
+            total = sum(self.stages.values())
+            return {
+                "words": total,
+                "stages": dict(self.stages),
+                "fractions": {stage: count / total if total else 0.0 for stage, count in self.stages.items()},
+                "rules": dict(self.rules)
+            }
+
+rule_classifier = RuleClassifier(Config.DEID_ALLOWLIST_PATH, Config.DEID_DENYLIST_PATH)
+classification_stats = ClassificationStats()
@@ -0,0 +1,147 @@
+import time
+import queue
+import threading
+from .metrics import register, add_collector, capture_stages, add_request_stages, Gauge, Histogram
+
+SCHEDULER_QUEUE_DEPTH = register(Gauge(
+    "deid_scheduler_queue_depth", "Classification requests and words waiting for the inference scheduler.", ["unit"]))
+SCHEDULER_BATCH_WORDS = register(Histogram(
+    "deid_scheduler_batch_words", "Distinct words per scheduled model call.",
+    buckets=(1, 8, 32, 64, 128, 256, 512, 1024, 2048, 4096)))
+SCHEDULER_BATCH_REQUESTS = register(Histogram(
+    "deid_scheduler_batch_requests", "Classification requests merged into one model call.",
+    buckets=(1, 2, 4, 8, 16, 32, 64)))
+SCHEDULER_WAIT_SECONDS = register(Histogram(
+    "deid_scheduler_wait_seconds", "Time a request waited before its model call started.",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)))
+
+class _Request:
+    def __init__(self, words):
+        self.words = words
+        self.submitted_at = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Stage times of the batch this request was part of.
+        self.stage_timings = {}
+
+class InferenceScheduler:
+    """
+    Merges model calls from concurrent threads into shared batches.
+
+    Callers block in predict() while a dispatcher thread collects pending
+    requests until max_batch_size words are waiting or max_wait seconds have
+    passed since the first one, runs predict_fn once over their distinct
+    words and hands every caller its own rows. When every caller currently
+    inside predict() is already in the batch, there is no one left to wait
+    for and the batch runs immediately.
+
+    The dispatcher thread has no request context, so the stage times of each
+    batch, plus the time spent waiting for it, are added to every caller's
+    request once its rows are ready.
+    """
+
+    def __init__(self, predict_fn, max_batch_size, max_wait):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._callers = 0
+        self._queued_words = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+                self._thread.start()
+
+    def predict(self, words):
+        """
+        Returns predict_fn(words), computed as part of a shared batch.
+        """
+        if not words:
+            return []
+        self._ensure_started()
+        request = _Request(words)
+        with self._lock:
+            self._callers += 1
+            self._queued_words += len(words)
+        try:
+            self._queue.put(request)
+            request.done.wait()
+        finally:
+            with self._lock:
+                self._callers -= 1
+        add_request_stages(request.stage_timings)
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        size = len(batch[0].words)
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            with self._lock:
+                everyone_here = len(batch) >= self._callers
+            if everyone_here and self._queue.empty():
+                break
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.words)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            with self._lock:
+                self._queued_words -= sum(len(request.words) for request in batch)
+            for request in batch:
+                SCHEDULER_WAIT_SECONDS.observe(started - request.submitted_at)
+                request.stage_timings["scheduler_wait"] = started - request.submitted_at
+
+            words = list(dict.fromkeys(word for request in batch for word in request.words))
+            SCHEDULER_BATCH_WORDS.observe(len(words))
+            SCHEDULER_BATCH_REQUESTS.observe(len(batch))
+            try:
+                with capture_stages() as timings:
+                    rows = dict(zip(words, self.predict_fn(words)))
+                for request in batch:
+                    request.result = [rows[word] for word in request.words]
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.stage_timings.update(timings)
+                request.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self._queue.qsize(), "words": self._queued_words}
+
+_schedulers = []
+
+def _collect_metrics():
+    requests = words = 0
+    for scheduler in _schedulers:
+        stats = scheduler.stats()
+        requests += stats["requests"]
+        words += stats["words"]
+    SCHEDULER_QUEUE_DEPTH.set(requests, unit="requests")
+    SCHEDULER_QUEUE_DEPTH.set(words, unit="words")
+
+add_collector(_collect_metrics)
+
+def create_scheduler(predict_fn, max_batch_size, max_wait):
+    scheduler = InferenceScheduler(predict_fn, max_batch_size, max_wait)
+    _schedulers.append(scheduler)
+    return scheduler
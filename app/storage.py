@@ -0,0 +1,291 @@
+import os
+import re
+import uuid
+import shutil
+import hashlib
+from datetime import timezone
+import tempfile
+import threading
+from flask import current_app, request, send_file
+from werkzeug.wsgi import FileWrapper
+from gridfs import GridFSBucket
+from gridfs.errors import NoFile
+from pymongo import MongoClient
+from config import Config
+from .database import mongo
+
+UPLOAD_PREFIX = "uploads"
+DEIDENTIFIED_PREFIX = "deidentified"
+RESULT_PREFIX = "results"
+
+def upload_key(record_id, extension=".pdf"):
+    return f"{UPLOAD_PREFIX}/{record_id}{extension}"
+
+def deidentified_key(record_id):
+    return f"{DEIDENTIFIED_PREFIX}/{record_id}_deidentified.pdf"
+
+def result_key():
+    # Outputs may be shared by several records, so they are not named after one.
+    return f"{RESULT_PREFIX}/{uuid.uuid4()}.pdf"
+
+class HashingReader:
+    """
+    Wraps a readable binary stream and hashes everything read through it, so
+    an upload is hashed while it is being stored.
+    """
+
+    def __init__(self, stream, algorithm="sha256"):
+        self.stream = stream
+        self.digest = hashlib.new(algorithm)
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.digest.update(chunk)
+        return chunk
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+class LocalStorage:
+    """
+    Stores files under a local directory; keys are relative paths.
+    """
+
+    # Other nodes have their own directory, so a listing only covers this node.
+    shared = False
+
+    def __init__(self, root, chunk_size):
+        self.root = root
+        self.chunk_size = chunk_size
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def save(self, key, stream):
+        """
+        Copies a readable binary stream to key chunk by chunk. Returns the size written.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = 0
+        with open(path, "wb") as f:
+            for chunk in iter(lambda: stream.read(self.chunk_size), b""):
+                f.write(chunk)
+                size += len(chunk)
+        return size
+
+    def open(self, key):
+        """
+        Returns a readable binary file object. Raises FileNotFoundError if missing.
+        """
+        return open(self.path(key), "rb")
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def delete_many(self, keys):
+        """
+        Deletes several keys. Returns how many files were removed.
+        """
+        return sum(1 for key in keys if self.delete(key))
+
+    def list(self, prefix):
+        """
+        Yields (key, size, modified) for every file stored under prefix;
+        modified is a POSIX timestamp.
+        """
+        try:
+            entries = os.scandir(self.path(prefix))
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    yield f"{prefix}/{entry.name}", stat.st_size, stat.st_mtime
+
+    def send(self, key, download_name, mimetype):
+        """
+        Returns a response that streams key to the client. Serving by path lets the
+        WSGI server use sendfile, and Flask answers If-None-Match/If-Modified-Since
+        with 304 and Range requests with 206 from the file's ETag and mtime.
+        Raises FileNotFoundError if missing.
+        """
+        path = os.path.abspath(self.path(key))
+        if not os.path.exists(path):
+            raise FileNotFoundError(key)
+        return send_file(path,
+                         as_attachment=True,
+                         download_name=download_name,
+                         mimetype=mimetype,
+                         conditional=True,
+                         etag=True)
+
+    def checkout(self, key):
+        """
+        Returns a local path with the contents of key for tools that need a real file.
+        Pass the path to release() when done.
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            raise FileNotFoundError(key)
+        return path
+
+    def release(self, path):
+        # Checked-out paths are the stored files themselves.
+        pass
+
+    def scratch(self, key):
+        """
+        Returns a local path to write the future contents of key to; see commit().
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def commit(self, key, path):
+        target = self.path(key)
+        if os.path.abspath(path) != os.path.abspath(target):
+            shutil.move(path, target)
+
+class GridFSStorage:
+    """
+    Stores files in a GridFS bucket, using the key as the file name, so every
+    node of a deployment sees the same files.
+    """
+
+    shared = True
+
+    def __init__(self, bucket_name, chunk_size):
+        self.bucket_name = bucket_name
+        self.chunk_size = chunk_size
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if mongo.db is not None:
+            return mongo.db
+        # Outside the Flask app (e.g. job worker processes) keep one client per process.
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = MongoClient(Config.MONGO_URI)
+                self._pid = os.getpid()
+            return self._client.get_default_database()
+
+    def _bucket(self):
+        return GridFSBucket(self._db(), bucket_name=self.bucket_name, chunk_size_bytes=self.chunk_size)
+
+    def _file_ids(self, key):
+        files = self._db()[f"{self.bucket_name}.files"]
+        return [doc["_id"] for doc in files.find({"filename": key}, {"_id": 1})]
+
+    def save(self, key, stream):
+        bucket = self._bucket()
+        old_ids = self._file_ids(key)
+        file_id = bucket.upload_from_stream(key, stream)
+        for old_id in old_ids:
+            bucket.delete(old_id)
+        return self._db()[f"{self.bucket_name}.files"].find_one({"_id": file_id}, {"length": 1})["length"]
+
+    def open(self, key):
+        try:
+            return self._bucket().open_download_stream_by_name(key)
+        except NoFile:
+            raise FileNotFoundError(key)
+
+    def exists(self, key):
+        return self._db()[f"{self.bucket_name}.files"].find_one({"filename": key}, {"_id": 1}) is not None
+
+    def delete(self, key):
+        bucket = self._bucket()
+        file_ids = self._file_ids(key)
+        for file_id in file_ids:
+            bucket.delete(file_id)
+        return bool(file_ids)
+
+    def delete_many(self, keys):
+        """
+        Deletes several keys with one delete_many per collection. Returns how
+        many GridFS files were removed.
+        """
+        db = self._db()
+        files = db[f"{self.bucket_name}.files"]
+        file_ids = [doc["_id"] for doc in files.find({"filename": {"$in": list(keys)}}, {"_id": 1})]
+        if file_ids:
+            db[f"{self.bucket_name}.chunks"].delete_many({"files_id": {"$in": file_ids}})
+            files.delete_many({"_id": {"$in": file_ids}})
+        return len(file_ids)
+
+    def list(self, prefix):
+        """
+        Yields (key, size, modified) for every file stored under prefix;
+        modified is a POSIX timestamp.
+        """
+        files = self._db()[f"{self.bucket_name}.files"]
+        query = {"filename": {"$regex": f"^{re.escape(prefix)}/"}}
+        for doc in files.find(query, {"filename": 1, "length": 1, "uploadDate": 1}):
+            yield doc["filename"], doc["length"], doc["uploadDate"].replace(tzinfo=timezone.utc).timestamp()
+
+    def send(self, key, download_name, mimetype):
+        """
+        Streams key from GridFS chunk by chunk with the same conditional and Range
+        handling as the local backend. The ETag is derived from the GridFS file id,
+        which changes whenever the file is replaced.
+        """
+        grid_out = self.open(key)
+        response = current_app.response_class(
+            FileWrapper(grid_out, self.chunk_size),
+            mimetype=mimetype,
+            direct_passthrough=True
+        )
+        response.content_length = grid_out.length
+        response.last_modified = grid_out.upload_date
+        response.set_etag(f"{grid_out._id}-{grid_out.length}")
+        response.headers.set("Content-Disposition", "attachment", filename=download_name)
+        return response.make_conditional(request.environ, accept_ranges=True, complete_length=grid_out.length)
+
+    def checkout(self, key):
+        extension = os.path.splitext(key)[1]
+        with self.open(key) as source:
+            with tempfile.NamedTemporaryFile(suffix=extension, delete=False) as target:
+                for chunk in iter(lambda: source.read(self.chunk_size), b""):
+                    target.write(chunk)
+        return target.name
+
+    def release(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def scratch(self, key):
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(key)[1])
+        os.close(fd)
+        return path
+
+    def commit(self, key, path):
+        with open(path, "rb") as f:
+            self.save(key, f)
+        os.remove(path)
+
+_storage = None
+
+def get_storage():
+    """
+    Returns the storage backend selected by Config.STORAGE_BACKEND.
+    """
+    global _storage
+    if _storage is None:
+        if Config.STORAGE_BACKEND == "gridfs":
+            _storage = GridFSStorage(Config.GRIDFS_BUCKET, Config.STORAGE_CHUNK_SIZE)
+        elif Config.STORAGE_BACKEND == "local":
+            _storage = LocalStorage(Config.STORAGE_ROOT, Config.STORAGE_CHUNK_SIZE)
+        else:
+            raise ValueError(f"Unknown storage backend: {Config.STORAGE_BACKEND}")
+    return _storage
@@ -1,25 +1,154 @@
 import requests
 import time
+import logging
+import threading
+from requests.adapters import HTTPAdapter
 from config import Config
-import http.client
-import json
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
 
 management_token = None
 token_expires_at = 0
+_token_lock = threading.Lock()
+
+_session = None
+_session_lock = threading.Lock()
+
+_users = None
+_users_fetched_at = 0
+_users_lock = threading.Lock()
+_users_fetch_lock = threading.Lock()
+_users_refreshing = False
+
+def get_session():
+    """
+    Returns the shared HTTP session, so Auth0 calls reuse pooled keep-alive
+    connections instead of doing a TLS handshake per request.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=Config.AUTH0_POOL_SIZE, max_retries=2)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+def reset_session():
+    """
+    Drops the pooled session, e.g. in a process forked from one that used it.
+    """
+    global _session
+    with _session_lock:
+        _session = None
 
 def get_management_token():
+    """
+    Returns a management API token, minting a new one only when the cached
+    token is missing or within AUTH0_TOKEN_REFRESH_MARGIN seconds of expiring.
+    """
+    global management_token, token_expires_at
+    with _token_lock:
+        if management_token and time.time() < token_expires_at - Config.AUTH0_TOKEN_REFRESH_MARGIN:
+            return management_token
+
+        payload = {
+            "client_id": Config.CLIENT_ID,
+            "client_secret": Config.CLIENT_SECRET,
+            "audience": Config.AUTH0_AUDIENCE,
+            "grant_type": "client_credentials",
+            "scope": "read:users"
+        }
+        with timed("auth0_token", items=1):
+            response = get_session().post(f"{Config.AUTH0_BASE_URL}/oauth/token", json=payload, timeout=Config.AUTH0_TIMEOUT)
+        response.raise_for_status()
+        json_data = response.json()
+
+        management_token = json_data.get("access_token")
+        token_expires_at = time.time() + json_data.get("expires_in", 86400)
+        return management_token
+
+def invalidate_management_token():
+    global management_token, token_expires_at
+    with _token_lock:
+        management_token = None
+        token_expires_at = 0
+
+def fetch_all_users():
+    """
+    Fetches every page of the management API users endpoint.
+    A rejected token is re-minted once before giving up.
+    """
+    users = []
+    page = 0
+    retried = False
+    while True:
+        headers = {'Authorization': f'Bearer {get_management_token()}'}
+        params = {"page": page, "per_page": Config.AUTH0_USERS_PER_PAGE, "include_totals": "true"}
+        with timed("auth0_users", items=1):
+            response = get_session().get(f"{Config.AUTH0_BASE_URL}/api/v2/users", headers=headers,
+                                         params=params, timeout=Config.AUTH0_TIMEOUT)
+        if response.status_code == 401 and not retried:
+            invalidate_management_token()
+            retried = True
+            continue
+        response.raise_for_status()
 
-    conn = http.client.HTTPSConnection("dev-4xalqwtpzkjsisfj.au.auth0.com")
+        data = response.json()
+        batch = data.get("users", []) if isinstance(data, dict) else data
+        users.extend(batch)
+        total = data.get("total") if isinstance(data, dict) else None
+        if len(batch) < Config.AUTH0_USERS_PER_PAGE or (total is not None and len(users) >= total):
+            return users
+        page += 1
 
-    payload = "{\"client_id\":\"XdIWkZTnVSf5qdsxVMRLZWBVuhokGv8s\",\"client_secret\":\"aZZwlHzsnJFvDvoYJPCd43hLscLVpKHLv6TmiJ-e1Ip4epAipgiL5ok40CzCFCP5\",\"audience\":\"https://dev-4xalqwtpzkjsisfj.au.auth0.com/api/v2/\",\"grant_type\":\"client_credentials\",\"scope\":\"read:users\"}"
+def _store_users(users):
+    global _users, _users_fetched_at
+    with _users_lock:
+        _users = users
+        _users_fetched_at = time.time()
 
-    headers = { 'content-type': "application/json" }
+def _refresh_users():
+    global _users_refreshing
+    try:
+        _store_users(fetch_all_users())
+    except Exception as e:
+        logger.warning("Failed to refresh users: %s", e)
+    finally:
+        with _users_lock:
+            _users_refreshing = False
 
-    conn.request("POST", "/oauth/token", payload, headers)
+def get_users():
+    """
+    Returns the user list from a short-lived cache. Within AUTH0_USERS_TTL the
+    cached list is returned as is; for AUTH0_USERS_STALE_TTL seconds after that
+    the stale list is returned while one background refresh runs; past that,
+    or with no list yet, the caller waits for a fresh fetch.
+    """
+    global _users_refreshing
+    with _users_lock:
+        age = time.time() - _users_fetched_at
+        if _users is not None and age < Config.AUTH0_USERS_TTL:
+            return _users
+        if _users is not None and age < Config.AUTH0_USERS_TTL + Config.AUTH0_USERS_STALE_TTL:
+            if not _users_refreshing:
+                _users_refreshing = True
+                threading.Thread(target=_refresh_users, daemon=True).start()
+            return _users
 
-    res = conn.getresponse()
-    data = res.read().decode("utf-8") 
-    json_data = json.loads(data)      
+    # Concurrent callers share one synchronous fetch.
+    with _users_fetch_lock:
+        with _users_lock:
+            if _users is not None and time.time() - _users_fetched_at < Config.AUTH0_USERS_TTL:
+                return _users
+        users = fetch_all_users()
+        _store_users(users)
+        return users
 
-    management_token = json_data.get("access_token")
-    return management_token
+def clear_users_cache():
+    global _users, _users_fetched_at
+    with _users_lock:
+        _users = None
+        _users_fetched_at = 0
@@ -0,0 +1,150 @@
+import os
+import sqlite3
+import threading
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+def file_fingerprint(*paths):
+    """
+    Returns a short hash of the size and modification time of the given files.
+    Used as the cache version so entries are dropped when a model file changes.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        except OSError:
+            digest.update(f"{path}:missing;".encode())
+    return digest.hexdigest()[:16]
+
+class WordCache:
+    """
+    Memoizes per-word arrays (embeddings or predictions) keyed by the normalized word.
+
+    Entries live in a size-limited in-process LRU and, when disk_path is set, in a
+    SQLite file that several worker processes can share. Every lookup checks the
+    version returned by version_fn and drops stale entries when it changes.
+    """
+
+    def __init__(self, namespace, max_size, version_fn, disk_path=None):
+        self.namespace = namespace
+        self.max_size = max_size
+        self.version_fn = version_fn
+        self.disk_path = disk_path
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.disk_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS word_cache ("
+                "namespace TEXT, version TEXT, word TEXT, value BLOB, "
+                "PRIMARY KEY (namespace, version, word))"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _check_version(self):
+        version = self.version_fn()
+        if version != self._version:
+            self._entries.clear()
+            if self.disk_path and self._version is not None:
+                conn = self._connection()
+                with conn:
+                    conn.execute(
+                        "DELETE FROM word_cache WHERE namespace = ? AND version != ?",
+                        (self.namespace, version),
+                    )
+            self._version = version
+        return version
+
+    def get_many(self, words):
+        """
+        Returns a dict with the cached value of every word that was found.
+        """
+        found = {}
+        with self._lock:
+            version = self._check_version()
+            for word in words:
+                if word in self._entries:
+                    self._entries.move_to_end(word)
+                    found[word] = self._entries[word]
+
+        missing = [word for word in words if word not in found]
+        if missing and self.disk_path:
+            conn = self._connection()
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT word, value FROM word_cache WHERE namespace = ? AND version = ? "
+                    f"AND word IN ({placeholders})",
+                    (self.namespace, version, *chunk),
+                ).fetchall()
+                for word, value in rows:
+                    found[word] = np.frombuffer(value, dtype=np.float32)
+            with self._lock:
+                for word in missing:
+                    if word in found:
+                        self.disk_hits += 1
+                        self._remember(word, found[word])
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(words) - len(found)
+        return found
+
+    def put_many(self, values):
+        """
+        Stores a dict of word -> 1-D array in the LRU and, if enabled, on disk.
+        """
+        values = {word: np.asarray(value, dtype=np.float32) for word, value in values.items()}
+        with self._lock:
+            version = self._check_version()
+            for word, value in values.items():
+                self._remember(word, value)
+
+        if values and self.disk_path:
+            conn = self._connection()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO word_cache (namespace, version, word, value) VALUES (?, ?, ?, ?)",
+                    [(self.namespace, version, word, value.tobytes()) for word, value in values.items()],
+                )
+
+    def _remember(self, word, value):
+        self._entries[word] = value
+        self._entries.move_to_end(word)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.disk_hits = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "namespace": self.namespace,
+                "version": self._version,
+                "size": len(self._entries),
+                "maxSize": self.max_size,
+                "hits": self.hits,
+                "diskHits": self.disk_hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "persistent": bool(self.disk_path),
+            }
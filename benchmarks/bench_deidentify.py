@@ -0,0 +1,242 @@
+"""
+Benchmarks the de-identification pipeline stage by stage on synthetic
+medical-record PDFs.
+
+    python -m benchmarks.bench_deidentify --pages 20 --spans 40 --field-ratio 0.6 --runs 5 --stub
+
+--stub swaps in a small deterministic model so the benchmark runs offline,
+without TensorFlow or the DistilBERT download; without it the real models
+are loaded through the model registry.
+"""
+import os
+import re
+import json
+import time
+import zlib
+import random
+import argparse
+import resource
+import tempfile
+import numpy as np
+from functools import lru_cache
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+from config import Config
+from app import deidentification
+from app.model_registry import registry, Models
+from app.rules import classification_stats
+
+FIELDS = ["Patient Name", "Date of Birth", "MRN", "Address", "Phone", "Physician", "Diagnosis",
+          "Medication", "Allergies", "Admission Date", "Discharge Date", "Next of Kin", "Insurance"]
+VALUE_WORDS = ["John", "Smith", "Mary", "Nguyen", "Chen", "12/03/1984", "0412-555-123", "1234567",
+               "12", "Baker", "Street", "Sydney", "Dr", "Patel", "hypertension", "type", "2", "diabetes",
+               "metformin", "500mg", "twice", "daily", "penicillin", "none", "known", "Medicare", "Bupa"]
+TEXT_WORDS = ["the", "patient", "was", "reviewed", "in", "clinic", "and", "reports", "improved", "symptoms",
+              "with", "no", "new", "complaints", "plan", "to", "continue", "current", "management"]
+
+HIDDEN_SIZE = 32
+
+def generate_record_pdf(path, pages, spans_per_page, field_ratio, seed=0):
+    """
+    Writes a synthetic record with spans_per_page lines per page. A field_ratio
+    share of the lines are "Field - value" lines the pipeline de-identifies;
+    the rest are free text it leaves alone.
+    """
+    rng = random.Random(seed)
+    c = canvas.Canvas(path, pagesize=letter)
+    line_height = (letter[1] - 72) / max(spans_per_page, 1)
+    for _ in range(pages):
+        for line in range(spans_per_page):
+            y = letter[1] - 36 - line * line_height
+            if rng.random() < field_ratio:
+                value = " ".join(rng.choice(VALUE_WORDS) for _ in range(rng.randint(1, 4)))
+                text = f"{rng.choice(FIELDS)} - {value}"
+            else:
+                text = " ".join(rng.choice(TEXT_WORDS) for _ in range(rng.randint(4, 10)))
+            c.setFont("Helvetica", min(10, line_height * 0.8))
+            c.drawString(36, y, text)
+        c.showPage()
+    c.save()
+
+def _word_id(word):
+    return zlib.crc32(word.lower().encode()) % 5000 + 1
+
+class StubTokenizer:
+    lower = True
+
+    def texts_to_sequences(self, texts):
+        return [[_word_id(text)] for text in texts]
+
+def _stub_sub_tokens(text, max_length):
+    """
+    Splits the words of text into pieces of up to four characters and returns
+    their (start, end) offsets between empty CLS and SEP offsets.
+    """
+    pieces = [(0, 0)]
+    for match in re.finditer(r"\S+", text):
+        for start in range(match.start(), match.end(), 4):
+            pieces.append((start, min(start + 4, match.end())))
+    return pieces[:max_length - 1] + [(0, 0)]
+
+class StubBertTokenizer:
+    """
+    Returns padded ids, attention masks and offsets like a fast tokenizer. The
+    CLS id stands for the whole text, so a lone word's CLS embedding is the
+    same as before sub-tokens existed.
+    """
+
+    def __call__(self, texts, max_length=512, return_offsets_mapping=False, **kwargs):
+        if isinstance(texts, str):
+            texts = [texts]
+        rows = [_stub_sub_tokens(text, max_length) for text in texts]
+        width = max(len(row) for row in rows)
+        input_ids = np.zeros((len(rows), width), dtype=np.int64)
+        attention_mask = np.zeros((len(rows), width), dtype=np.int64)
+        offsets = np.zeros((len(rows), width, 2), dtype=np.int64)
+        for index, (text, row) in enumerate(zip(texts, rows)):
+            input_ids[index, 0] = _word_id(text)
+            input_ids[index, 1:len(row) - 1] = [_word_id(text[start:end]) for start, end in row[1:-1]]
+            attention_mask[index, :len(row)] = 1
+            offsets[index, :len(row)] = row
+        encoding = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if return_offsets_mapping:
+            encoding["offset_mapping"] = offsets
+        return encoding
+
+class StubBertOutput:
+    def __init__(self, last_hidden_state):
+        self.last_hidden_state = last_hidden_state
+
+@lru_cache(maxsize=None)
+def _stub_embedding(token_id):
+    return np.random.default_rng(token_id).standard_normal(HIDDEN_SIZE).astype(np.float32)
+
+class StubBertModel:
+    """
+    Returns a deterministic pseudo-embedding per token id.
+    """
+
+    def __call__(self, inputs):
+        ids = np.asarray(inputs["input_ids"])
+        hidden = np.stack([np.stack([_stub_embedding(int(i)) for i in row]) for row in ids])
+        return StubBertOutput(hidden)
+
+class StubClassifier:
+    def predict(self, inputs, batch_size=None, verbose=0):
+        embeddings = inputs[0]
+        phi = (embeddings[:, 0] > 0.8).astype(np.float32)
+        return np.stack([1 - phi, phi], axis=1)
+
+def stub_models():
+    return Models(StubTokenizer(), StubClassifier(), StubBertTokenizer(), StubBertModel())
+
+def percentile(values, p):
+    return float(np.percentile(values, p)) if values else 0.0
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if os.uname().sysname == "Darwin" else peak / 1024
+
+def run_benchmark(pages, spans_per_page, field_ratio, runs, warm_cache=False, engine="reportlab", seed=0):
+    """
+    Times extraction, classification and rendering separately over several runs.
+    Returns a dict with per-stage p50/p95 in seconds and throughput numbers.
+    """
+    stages = {"extract_text_and_positions": [], "deidentify_text": [], "create_deidentified_pdf": []}
+    word_counts = []
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, "record.pdf")
+        output_path = os.path.join(tmp, "record_deidentified.pdf")
+        generate_record_pdf(input_path, pages, spans_per_page, field_ratio, seed)
+
+        for _ in range(runs):
+            if not warm_cache:
+                deidentification.embedding_cache.clear()
+                deidentification.prediction_cache.clear()
+                deidentification.line_cache.clear()
+            classification_stats.reset()
+
+            started = time.perf_counter()
+            text_blocks = deidentification.extract_text_and_positions(input_path)
+            stages["extract_text_and_positions"].append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            word_counts.append(deidentification.deidentify_blocks(text_blocks))
+            stages["deidentify_text"].append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            if engine == "redact":
+                pages_blocks = {}
+                for block in text_blocks:
+                    pages_blocks.setdefault(block["page_num"], []).append(block)
+                deidentification.create_redacted_pdf(input_path, sorted(pages_blocks.items()), output_path)
+            else:
+                deidentification.create_deidentified_pdf(text_blocks, output_path)
+            stages["create_deidentified_pdf"].append(time.perf_counter() - started)
+
+    totals = [sum(run) for run in zip(*stages.values())]
+    words = word_counts[-1] if word_counts else 0
+    classify_p50 = percentile(stages["deidentify_text"], 50)
+    total_p50 = percentile(totals, 50)
+    return {
+        "pages": pages,
+        "spansPerPage": spans_per_page,
+        "fieldRatio": field_ratio,
+        "runs": runs,
+        "engine": engine,
+        "inferenceMode": Config.DEID_INFERENCE_MODE,
+        "model": "stub" if isinstance(registry.get().loaded_model, StubClassifier) else "real",
+        "wordsPerDocument": words,
+        "stages": {
+            name: {"p50": percentile(times, 50), "p95": percentile(times, 95)}
+            for name, times in stages.items()
+        },
+        "total": {"p50": total_p50, "p95": percentile(totals, 95)},
+        "wordsPerSecond": words / classify_p50 if classify_p50 else 0.0,
+        "pagesPerSecond": pages / total_p50 if total_p50 else 0.0,
+        "peakRssMb": peak_rss_mb(),
+        "classification": classification_stats.to_dict()
+    }
+
+def format_report(result):
+    lines = [
+        f"{result['pages']} pages, {result['spansPerPage']} spans/page, field ratio {result['fieldRatio']}, "
+        f"{result['runs']} runs, {result['model']} model, {result['engine']} engine, "
+        f"{result['inferenceMode']} inference",
+        f"{'stage':<28}{'p50 ms':>10}{'p95 ms':>10}"
+    ]
+    for name, timing in list(result["stages"].items()) + [("total", result["total"])]:
+        lines.append(f"{name:<28}{timing['p50'] * 1000:>10.1f}{timing['p95'] * 1000:>10.1f}")
+    lines.append(f"words/sec {result['wordsPerSecond']:.0f}  pages/sec {result['pagesPerSecond']:.2f}  "
+                 f"peak RSS {result['peakRssMb']:.0f} MB")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the de-identification pipeline.")
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--spans", type=int, default=40, help="text lines per page")
+    parser.add_argument("--field-ratio", type=float, default=0.5, help="share of 'field - value' lines")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--engine", choices=deidentification.OUTPUT_ENGINES, default="reportlab")
+    parser.add_argument("--inference-mode", choices=("word", "line"), default=None,
+                        help="override DEID_INFERENCE_MODE")
+    parser.add_argument("--warm-cache", action="store_true", help="keep word caches between runs")
+    parser.add_argument("--stub", action="store_true", help="use the offline stub model")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args()
+
+    if args.inference_mode:
+        Config.DEID_INFERENCE_MODE = args.inference_mode
+    if args.stub:
+        registry.use(stub_models())
+    else:
+        registry.warm_up()
+
+    result = run_benchmark(args.pages, args.spans, args.field_ratio, args.runs,
+                           args.warm_cache, args.engine, args.seed)
+    print(json.dumps(result, indent=2) if args.json else format_report(result))
+
+if __name__ == "__main__":
+    main()
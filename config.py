@@ -6,3 +6,137 @@ class Config:
     AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'dev-4xalqwtpzkjsisfj.au.auth0.com')
     CLIENT_ID = os.environ.get('CLIENT_ID', 'XdIWkZTnVSf5qdsxVMRLZWBVuhokGv8s')
     CLIENT_SECRET = os.environ.get('CLIENT_SECRET', 'aZZwlHzsnJFvDvoYJPCd43hLscLVpKHLv6TmiJ-e1Ip4epAipgiL5ok40CzCFCP5')
+    # Point AUTH0_BASE_URL at a local stub server to test without Auth0.
+    AUTH0_BASE_URL = os.environ.get('AUTH0_BASE_URL', f'https://{AUTH0_DOMAIN}')
+    AUTH0_AUDIENCE = os.environ.get('AUTH0_AUDIENCE', f'https://{AUTH0_DOMAIN}/api/v2/')
+    AUTH0_TIMEOUT = float(os.environ.get('AUTH0_TIMEOUT', 10))
+    AUTH0_POOL_SIZE = int(os.environ.get('AUTH0_POOL_SIZE', 10))
+    # Seconds before expiry at which the cached management token is re-minted.
+    AUTH0_TOKEN_REFRESH_MARGIN = int(os.environ.get('AUTH0_TOKEN_REFRESH_MARGIN', 60))
+    AUTH0_USERS_PER_PAGE = int(os.environ.get('AUTH0_USERS_PER_PAGE', 100))
+    # The user list is fresh for AUTH0_USERS_TTL seconds, then served stale
+    # while refreshing for up to AUTH0_USERS_STALE_TTL more.
+    AUTH0_USERS_TTL = int(os.environ.get('AUTH0_USERS_TTL', 60))
+    AUTH0_USERS_STALE_TTL = int(os.environ.get('AUTH0_USERS_STALE_TTL', 300))
+
+    # Where uploads and de-identified files are kept: "local" (under STORAGE_ROOT)
+    # or "gridfs" (shared by every node through MongoDB).
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+    STORAGE_ROOT = os.environ.get('STORAGE_ROOT', '.')
+    GRIDFS_BUCKET = os.environ.get('GRIDFS_BUCKET', 'files')
+    STORAGE_CHUNK_SIZE = int(os.environ.get('STORAGE_CHUNK_SIZE', 255 * 1024))
+
+    # Storage sweeper: every MAINTENANCE_INTERVAL_SECONDS (0, the default,
+    # disables it) one process per node (per deployment with gridfs) removes
+    # uploads older than UPLOAD_TTL_SECONDS and de-identified files no record
+    # uses after OUTPUT_TTL_SECONDS, MAINTENANCE_BATCH_SIZE at a time. Above
+    # STORAGE_QUOTA_BYTES (0 for no quota) the oldest unused files older than
+    # STORAGE_QUOTA_MIN_AGE_SECONDS are removed first.
+    # MAINTENANCE_DELETE_ORPHANED_RECORDS also deletes records whose file is
+    # gone; it needs the gridfs backend, since a local listing only shows one
+    # node's files.
+    MAINTENANCE_INTERVAL_SECONDS = int(os.environ.get('MAINTENANCE_INTERVAL_SECONDS', 0))
+    MAINTENANCE_DELETE_ORPHANED_RECORDS = os.environ.get('MAINTENANCE_DELETE_ORPHANED_RECORDS', 'false').lower() == 'true'
+    MAINTENANCE_BATCH_SIZE = int(os.environ.get('MAINTENANCE_BATCH_SIZE', 500))
+    UPLOAD_TTL_SECONDS = int(os.environ.get('UPLOAD_TTL_SECONDS', 24 * 3600))
+    OUTPUT_TTL_SECONDS = int(os.environ.get('OUTPUT_TTL_SECONDS', 24 * 3600))
+    STORAGE_QUOTA_BYTES = int(os.environ.get('STORAGE_QUOTA_BYTES', 0))
+    STORAGE_QUOTA_MIN_AGE_SECONDS = int(os.environ.get('STORAGE_QUOTA_MIN_AGE_SECONDS', 600))
+
+    # Batch uploads: files de-identified at once and files accepted per request.
+    BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 4))
+    BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', 500))
+
+    # Page size of /findAllRecords (clients may ask for up to RECORDS_MAX_PAGE_SIZE).
+    RECORDS_PAGE_SIZE = int(os.environ.get('RECORDS_PAGE_SIZE', 50))
+    RECORDS_MAX_PAGE_SIZE = int(os.environ.get('RECORDS_MAX_PAGE_SIZE', 500))
+
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    # Share of newly classified words whose prediction is logged at DEBUG level.
+    PREDICTION_LOG_SAMPLE_RATE = float(os.environ.get('PREDICTION_LOG_SAMPLE_RATE', 0.01))
+    # Requests slower than this are logged with their per-stage breakdown.
+    SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 5))
+    # With several server processes (gunicorn), each one writes its metrics to
+    # METRICS_DIR every METRICS_WRITE_SECONDS and /metrics on any of them
+    # reports the sum over all. Unset, /metrics covers only the process serving it.
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_WRITE_SECONDS = float(os.environ.get('METRICS_WRITE_SECONDS', 5))
+
+    # How de-identified PDFs are written: "reportlab" re-renders the text,
+    # "redact" applies redaction annotations to the original document.
+    DEID_OUTPUT_ENGINE = os.environ.get('DEID_OUTPUT_ENGINE', 'reportlab')
+
+    # OCR for pages without a text layer: rasterization DPI, Tesseract language,
+    # OCR worker processes, and the page-result cache (in memory, plus on disk
+    # when OCR_CACHE_DIR is set).
+    OCR_ENABLED = os.environ.get('OCR_ENABLED', 'true').lower() == 'true'
+    OCR_DPI = int(os.environ.get('OCR_DPI', 300))
+    OCR_LANG = os.environ.get('OCR_LANG', 'eng')
+    OCR_WORKERS = int(os.environ.get('OCR_WORKERS', 4))
+    OCR_CACHE_SIZE = int(os.environ.get('OCR_CACHE_SIZE', 1000))
+    OCR_CACHE_DIR = os.environ.get('OCR_CACHE_DIR')
+
+    # Number of words embedded and classified per model call.
+    DEID_BATCH_SIZE = int(os.environ.get('DEID_BATCH_SIZE', 256))
+    # "word" embeds every word on its own; "line" runs DistilBERT once per
+    # "field - value" line so each word is classified in context, from the
+    # hidden states of its own sub-tokens. Line mode needs the eager models.
+    # Compare the two with `flask evaluate-inference-mode`.
+    DEID_INFERENCE_MODE = os.environ.get('DEID_INFERENCE_MODE', 'word')
+
+    # Cross-request micro-batching: concurrent classifications in one process
+    # are merged into a single model call of up to INFERENCE_MAX_BATCH_SIZE
+    # distinct words, waiting at most INFERENCE_MAX_WAIT_MS for other callers.
+    # Larger values trade latency for throughput.
+    INFERENCE_SCHEDULER_ENABLED = os.environ.get('INFERENCE_SCHEDULER_ENABLED', 'true').lower() == 'true'
+    INFERENCE_MAX_BATCH_SIZE = int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 1024))
+    INFERENCE_MAX_WAIT_MS = float(os.environ.get('INFERENCE_MAX_WAIT_MS', 5))
+
+    # Page-parallel mode: documents longer than one chunk are split into ranges
+    # of DEID_PAGE_CHUNK_SIZE pages processed by this many worker processes.
+    # 0 keeps processing sequential.
+    DEID_PARALLEL_WORKERS = int(os.environ.get('DEID_PARALLEL_WORKERS', 0))
+    DEID_PAGE_CHUNK_SIZE = int(os.environ.get('DEID_PAGE_CHUNK_SIZE', 16))
+
+    # Rule stage in front of the model. The optional files add one term per line
+    # to the built-in allowlist (never PHI) and to the denylist (always PHI).
+    DEID_RULES_ENABLED = os.environ.get('DEID_RULES_ENABLED', 'true').lower() == 'true'
+    DEID_ALLOWLIST_PATH = os.environ.get('DEID_ALLOWLIST_PATH')
+    DEID_DENYLIST_PATH = os.environ.get('DEID_DENYLIST_PATH')
+
+    MODEL_PATH = os.environ.get('MODEL_PATH', 'latest_model.keras')
+    TOKENIZER_PATH = os.environ.get('TOKENIZER_PATH', 'latest_tokenizer.pkl')
+    BERT_MODEL_NAME = os.environ.get('BERT_MODEL_NAME', 'distilbert-base-uncased')
+    # Inference backend: "eager" runs the Keras classifier and DistilBERT as
+    # loaded, "compiled" requires the single-graph artifact written by
+    # `flask export-model`, and "auto" uses that artifact when it exists and
+    # falls back to the eager models otherwise. A ".tflite" path is served with
+    # the TFLite interpreter (INFERENCE_THREADS threads, 0 for its default),
+    # anything else is loaded as an XLA-compiled SavedModel directory.
+    INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'auto')
+    COMPILED_MODEL_PATH = os.environ.get('COMPILED_MODEL_PATH', 'compiled_model.tflite')
+    INFERENCE_THREADS = int(os.environ.get('INFERENCE_THREADS', 0))
+    # TensorFlow intra-/inter-op thread pools of each process that loads the
+    # models (0 keeps TensorFlow's default of one thread per core).
+    TF_INTRA_OP_THREADS = int(os.environ.get('TF_INTRA_OP_THREADS', 0))
+    TF_INTER_OP_THREADS = int(os.environ.get('TF_INTER_OP_THREADS', 0))
+    # Models load on first use unless this is set, in which case create_app
+    # starts loading them in the background.
+    WARM_UP_MODELS = os.environ.get('WARM_UP_MODELS', 'false').lower() == 'true'
+
+    # Per-word embedding/prediction cache. Set WORD_CACHE_PATH to share entries
+    # between worker processes through a SQLite file.
+    WORD_CACHE_SIZE = int(os.environ.get('WORD_CACHE_SIZE', 50000))
+    WORD_CACHE_PATH = os.environ.get('WORD_CACHE_PATH')
+
+    # De-identification jobs: worker processes running at once, jobs allowed to
+    # wait or run before new submissions are rejected (both per web worker), and
+    # how long finished jobs stay queryable. Job status is kept in MongoDB, so
+    # any web worker can report a job.
+    DEID_MAX_CONCURRENT_JOBS = int(os.environ.get('DEID_MAX_CONCURRENT_JOBS', 2))
+    # "process" runs jobs in spawned workers that load their own models;
+    # "thread" runs them in threads sharing this process's models, as the
+    # gunicorn configuration (gunicorn.conf.py) does.
+    DEID_JOB_EXECUTOR = os.environ.get('DEID_JOB_EXECUTOR', 'process')
+    DEID_MAX_QUEUED_JOBS = int(os.environ.get('DEID_MAX_QUEUED_JOBS', 8))
+    DEID_JOB_TTL_SECONDS = int(os.environ.get('DEID_JOB_TTL_SECONDS', 3600))
@@ -0,0 +1,166 @@
+"""
+Gunicorn settings for production serving, picked up from the working directory:
+
+    gunicorn run:app
+
+The app is loaded once in the gunicorn master (preload_app) and, with
+PRELOAD_MODELS (the default), so are the models, which are warmed before
+the workers are forked. Model weights, tokenizers and everything else
+loaded before the fork are shared copy-on-write instead of being loaded
+once per worker. Jobs run in threads inside each worker so they use the
+shared models too. Their status is kept in MongoDB, so a job can be polled
+through any worker, and every process writes its metrics to METRICS_DIR (a
+temporary directory unless set) so /metrics on any worker reports the whole
+server. The storage sweeper, when enabled, only runs in the master.
+
+TensorFlow's thread pools do not survive fork(). With PRELOAD_MODELS the
+pools are therefore sized to one thread, which makes TensorFlow run kernels
+inline in the calling thread, and CPU parallelism comes from the workers.
+Every worker runs a small inference before it accepts requests and gunicorn
+refuses to start if that does not finish. With PRELOAD_MODELS=false every
+worker loads its own models after the fork, with MODEL_THREADS threads per
+pool (0 for TensorFlow's default).
+
+Each worker logs its memory once it is ready and the master logs every
+worker's (rss, and pss, which splits shared pages between the processes
+using them) every MEMORY_REPORT_SECONDS.
+"""
+import os
+import gc
+import glob
+import time
+import shutil
+import tempfile
+import logging
+import threading
+from config import Config
+
+bind = os.environ.get("BIND", "127.0.0.1:5000")
+workers = int(os.environ.get("WEB_WORKERS", os.cpu_count() or 1))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+# Synchronous de-identification of a long document can take minutes.
+timeout = int(os.environ.get("WEB_TIMEOUT", 300))
+preload_app = True
+
+preload_models = os.environ.get("PRELOAD_MODELS", "true").lower() == "true"
+model_threads = int(os.environ.get("MODEL_THREADS", 0))
+ready_timeout = float(os.environ.get("WORKER_READY_TIMEOUT", 120))
+memory_report_seconds = float(os.environ.get("MEMORY_REPORT_SECONDS", 300))
+
+# Applied before gunicorn loads the app.
+if preload_models:
+    Config.TF_INTRA_OP_THREADS = 1
+    Config.TF_INTER_OP_THREADS = 1
+    Config.INFERENCE_THREADS = 1
+elif model_threads:
+    Config.TF_INTRA_OP_THREADS = model_threads
+    Config.TF_INTER_OP_THREADS = model_threads
+    Config.INFERENCE_THREADS = model_threads
+Config.DEID_JOB_EXECUTOR = "thread"
+created_metrics_dir = not Config.METRICS_DIR
+if created_metrics_dir:
+    Config.METRICS_DIR = tempfile.mkdtemp(prefix="deid-metrics-")
+# The models are loaded by the hooks below rather than in a background thread.
+Config.WARM_UP_MODELS = False
+
+# Gunicorn's exit code for a worker that failed to boot; the master stops on it.
+WORKER_BOOT_ERROR = 3
+
+logger = logging.getLogger("gunicorn.error")
+
+def _warm_up_models():
+    from app.model_registry import registry
+    from app.deidentification import predict_words
+
+    models = registry.warm_up()
+    # The first call builds the graphs; the word caches are left alone so no
+    # SQLite connection is opened before the fork.
+    predict_words(models, ["warm", "up"], 2)
+
+def _format_memory(memory):
+    return "rss %.0f MB, pss %.0f MB, shared %.0f MB, private %.0f MB" % tuple(
+        memory[kind] / 2**20 for kind in ("rss", "pss", "shared", "private"))
+
+def _report_memory(server):
+    from app.metrics import read_memory
+
+    totals = {"rss": 0, "pss": 0}
+    for name, pid in [("master", os.getpid())] + [(f"worker {worker.age}", pid) for pid, worker in list(server.WORKERS.items())]:
+        memory = read_memory(pid)
+        if memory is None:
+            continue
+        totals["rss"] += memory["rss"]
+        totals["pss"] += memory["pss"]
+        logger.info("Memory of %s (pid %d): %s", name, pid, _format_memory(memory))
+    logger.info("Total memory: rss %.0f MB, pss %.0f MB (pss is what the processes actually use together)",
+                totals["rss"] / 2**20, totals["pss"] / 2**20)
+
+def _report_memory_periodically(server):
+    while True:
+        time.sleep(memory_report_seconds)
+        try:
+            _report_memory(server)
+        except Exception as e:
+            logger.warning("Memory report failed: %s", e)
+
+def on_starting(server):
+    # Files left by an earlier run would be counted as exited workers.
+    for path in glob.glob(os.path.join(Config.METRICS_DIR, "*.json")):
+        os.remove(path)
+    if preload_models:
+        started = time.time()
+        _warm_up_models()
+        logger.info("Models loaded and warmed in the master in %.1fs", time.time() - started)
+        # Objects created so far are never collected again, so the collector
+        # in the workers does not write to (and un-share) their pages.
+        gc.collect()
+        gc.freeze()
+
+def when_ready(server):
+    from app.metrics import start_metrics_writer
+
+    start_metrics_writer(Config.METRICS_DIR, Config.METRICS_WRITE_SECONDS)
+    if memory_report_seconds:
+        threading.Thread(target=_report_memory_periodically, args=(server,), name="memory-report", daemon=True).start()
+
+def post_fork(server, worker):
+    from app import reinit_after_fork
+    from app.metrics import start_metrics_writer
+
+    reinit_after_fork(worker.app.wsgi())
+    start_metrics_writer(Config.METRICS_DIR, Config.METRICS_WRITE_SECONDS)
+
+def post_worker_init(worker):
+    """
+    Runs one small inference (loading the models first without
+    PRELOAD_MODELS) before the worker takes requests. A worker whose
+    inherited models hang exits with WORKER_BOOT_ERROR, which stops gunicorn.
+    """
+    from app.metrics import read_memory
+
+    finished = threading.Event()
+    errors = []
+
+    def run():
+        try:
+            _warm_up_models()
+            finished.set()
+        except Exception as e:
+            errors.append(e)
+            finished.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    if not finished.wait(ready_timeout):
+        logger.error("Worker %d: models are not usable after fork; try PRELOAD_MODELS=false", os.getpid())
+        os._exit(WORKER_BOOT_ERROR)
+    if errors:
+        raise errors[0]
+
+    memory = read_memory()
+    if memory is not None:
+        logger.info("Worker %d ready: %s", os.getpid(), _format_memory(memory))
+
+def on_exit(server):
+    if created_metrics_dir:
+        shutil.rmtree(Config.METRICS_DIR, ignore_errors=True)